@@ -0,0 +1,84 @@
+"""
+Compare the udp and aiodns engines against a local stand-in DNS server
+The server runs in its own process and answers every A query with one record,
+so the numbers are the cost of the clients, not of a real resolver.
+
+    python bench/bench_dns_engines.py
+    python bench/bench_dns_engines.py -n 100000 -c 300,2000
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import multiprocessing
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiodns  # noqa: E402
+import subdomain_brute  # noqa: E402
+
+# www.example.test A 10.0.0.2, ttl 60, pointing at the question name
+ANSWER = b'\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x3c\x00\x04\x0a\x00\x00\x02'
+
+
+def stand_in_server(sock):
+    while True:
+        data, address = sock.recvfrom(512)
+        sock.sendto(data[:2] + b'\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00' + data[12:] + ANSWER, address)
+
+
+async def run_engine(engine, address, port, count, concurrency):
+    loop = asyncio.get_event_loop()
+    if engine == 'udp':
+        resolver = subdomain_brute.UDPResolver(address, loop=loop, port=port)
+    else:
+        resolver = aiodns.DNSResolver(loop=loop, nameservers=[address], udp_port=port, timeout=3)
+    names = iter([f'n{i}.example.test' for i in range(count)])
+    answered = errors = 0
+
+    async def worker():
+        nonlocal answered, errors
+        for name in names:
+            try:
+                await resolver.query(name, 'A')
+                answered += 1
+            except aiodns.error.DNSError:
+                errors += 1
+
+    start, cpu = time.perf_counter(), time.process_time()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+    if engine == 'udp':
+        resolver.close()
+    print(f'{engine:>6} {concurrency:>5} in flight: {count / elapsed:8.0f} q/s, '
+          f'{cpu * 1e6 / count:6.1f} us CPU per lookup, {errors} errors')
+
+
+def main():
+    parser = OptionParser('Usage: python bench_dns_engines.py [-n COUNT] [-c CONCURRENCY,...]')
+    parser.add_option('-n', '--count', dest='count', type='int', default=100000, help='Lookups per run')
+    parser.add_option('-c', '--concurrency', dest='concurrency', default='300,2000',
+                      help='Lookups in flight, comma separated')
+    (options, args) = parser.parse_args()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 24)
+    sock.bind(('127.0.0.1', 0))
+    address, port = sock.getsockname()
+    server = multiprocessing.Process(target=stand_in_server, args=(sock,), daemon=True)
+    server.start()
+    sock.close()
+    try:
+        for concurrency in map(int, options.concurrency.split(',')):
+            for engine in ('udp', 'aiodns'):
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                loop.run_until_complete(run_engine(engine, address, port, options.count, concurrency))
+                loop.close()
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
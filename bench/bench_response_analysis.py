@@ -0,0 +1,100 @@
+"""
+Time the RSC response analysis, per KB of input
+Compares the regexes analyze_response used before ResponseAnalyzer with ResponseAnalyzer.clean and hosts
+
+    python bench/bench_response_analysis.py -d rust-lang.org /path/to/html/**/*.html
+    python bench/bench_response_analysis.py
+
+Without files, synthetic pages mentioning hosts of the domain are generated.
+"""
+import os
+import re
+import sys
+import time
+import random
+import string
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import subdomain_brute  # noqa: E402
+
+
+def legacy(data, domain):
+    """
+    data_clean and the domain findall of analyze_response, before ResponseAnalyzer
+    :param data:
+    :param domain:
+    :return: cleaned html, hosts
+    """
+    html = re.sub(r'\s', '', data)
+    html = re.sub(r'<script(?!.*?src=).*?>.*?</script>', '', html)
+    rds = re.findall(r"((?!\/)(?:(?:[a-z\d-]*\.)+{d}))".format(d=domain), html)
+    return html, {rd.strip().strip('.') for rd in rds}
+
+
+def synthetic_pages(domain, count=200, seed=7):
+    rnd = random.Random(seed)
+    words = [''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randrange(2, 10))) for _ in range(500)]
+    pages = []
+    for _ in range(count):
+        parts = ['<html><head><script src="https://cdn.{d}/app.js"></script></head><body>'.format(d=domain)]
+        for _ in range(rnd.randrange(200, 2000)):
+            roll = rnd.random()
+            if roll < 0.02:
+                parts.append(f'<a href="https://{rnd.choice(words)}.{domain}/{rnd.choice(words)}">link</a>')
+            elif roll < 0.03:
+                parts.append(f'<script>\n  var {rnd.choice(words)} = "{rnd.choice(words)}";\n</script>')
+            else:
+                parts.append(rnd.choice(words) + (' ' if rnd.random() < 0.9 else '\n  '))
+        parts.append('</body></html>')
+        pages.append(''.join(parts))
+    return pages
+
+
+def best_of(fn, pages, rounds):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for page in pages:
+            fn(page)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = OptionParser('Usage: python bench_response_analysis.py [-d DOMAIN] [-r ROUNDS] [HTML_FILE...]')
+    parser.add_option('-d', '--domain', dest='domain', default='example.com', help='Domain whose hosts are looked for')
+    parser.add_option('-r', '--rounds', dest='rounds', type='int', default=3, help='Rounds, the best one is reported')
+    (options, args) = parser.parse_args()
+    domain = options.domain
+    if args:
+        pages = []
+        for path in args:
+            with open(path, encoding='utf-8', errors='replace') as fp:
+                pages.append(fp.read())
+    else:
+        pages = synthetic_pages(domain)
+    kb = sum(len(page) for page in pages) / 1024
+    print(f'{len(pages)} pages, {kb:.0f} KB, domain {domain}')
+
+    analyzer = subdomain_brute.ResponseAnalyzer(domain, subdomain_brute.LengthSimilarity())
+    runs = (
+        ('legacy', lambda page: legacy(page, domain)),
+        ('clean + hosts', lambda page: (analyzer.clean(page), analyzer.hosts(page))),
+        ('clean', analyzer.clean),
+        ('hosts', analyzer.hosts),
+    )
+    for name, fn in runs:
+        print(f'{name:>14} {best_of(fn, pages, options.rounds) * 1e6 / kb:8.1f} us/KB')
+
+    old_hosts, new_hosts = set(), set()
+    for page in pages:
+        old_hosts |= legacy(page, domain)[1]
+        new_hosts |= analyzer.hosts(page)
+    print(f'hosts found by legacy only: {sorted(old_hosts - new_hosts)[:10]}')
+    print(f'hosts found by ResponseAnalyzer only: {sorted(new_hosts - old_hosts)[:10]}')
+
+
+if __name__ == '__main__':
+    main()
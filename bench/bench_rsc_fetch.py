@@ -0,0 +1,86 @@
+"""
+Time the RSC fetches of a single IP wildcard, for several connection limits per IP
+Every candidate of such a wildcard resolves to the same IP, so the connector's limit per host
+caps the requests in flight. The stand-in web server runs in its own process and answers after
+--delay ms, standing in for the round trip and the server time of a remote host.
+
+    python bench/bench_rsc_fetch.py
+    python bench/bench_rsc_fetch.py -n 5000 --delay 80 --per-host 32,100
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import multiprocessing
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web  # noqa: E402
+import subdomain_brute  # noqa: E402
+
+PARKED = '<html><body>parked domain, for sale</body></html>'
+
+
+def stand_in_server(sock, delay):
+    async def parked(request):
+        await asyncio.sleep(delay)
+        return web.Response(text=PARKED, content_type='text/html')
+
+    app = web.Application()
+    app.router.add_route('GET', '/{tail:.*}', parked)
+    web.run_app(app, sock=sock, print=None, handle_signals=False)
+
+
+async def run(esd, port, count):
+    loop = asyncio.get_event_loop()
+    for i in range(count):
+        esd.cache.entries[(f'park{i}.example.test', 'A')] = (loop.time() + 600, [subdomain_brute.ARecord('127.0.0.1', 60)],
+                                                             None)
+    session = esd.http_session()
+    failed = 0
+
+    async def fetch(i):
+        nonlocal failed
+        html, _ = await esd.fetch(session, f'http://park{i}.example.test:{port}/')
+        if html is None:
+            failed += 1
+
+    start = time.perf_counter()
+    await esd.start_e((fetch(i) for i in range(count)), None, esd.coroutine_count_request)
+    elapsed = time.perf_counter() - start
+    await esd.close_http_session()
+    return elapsed, failed
+
+
+def main():
+    parser = OptionParser('Usage: python bench_rsc_fetch.py [-n COUNT] [--delay MS] [--per-host N,...]')
+    parser.add_option('-n', '--count', dest='count', type='int', default=3000, help='Candidates fetched per run')
+    parser.add_option('--delay', dest='delay', type='float', default=50, help='Response delay of the server in ms')
+    parser.add_option('--per-host', dest='per_host', default='32,100', help='Connections per IP, comma separated')
+    (options, args) = parser.parse_args()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1024)
+    port = sock.getsockname()[1]
+    server = multiprocessing.Process(target=stand_in_server, args=(sock, options.delay / 1000), daemon=True)
+    server.start()
+    sock.close()
+    try:
+        for per_host in map(int, options.per_host.split(',')):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            esd = subdomain_brute.EnumSubDomain('example.test', dns_servers=['127.0.0.1'], http_per_host=per_host)
+            esd.progress = False
+            esd.cache = subdomain_brute.DNSCache(None, loop)
+            elapsed, failed = loop.run_until_complete(run(esd, port, options.count))
+            loop.close()
+            print(f'{per_host:>4} per host, {esd.coroutine_count_request} in flight: '
+                  f'{options.count / elapsed:7.0f} fetches/s, {failed} failed')
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
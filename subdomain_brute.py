@@ -17,7 +17,12 @@ import re
 import sys
 import time
 import ssl
-import math
+import mmap
+import struct
+import hashlib
+import zlib
+import sqlite3
+import json
 import string
 import random
 import traceback
@@ -33,15 +38,20 @@ import backoff
 import socket
 import async_timeout
 import dns.query
+import dns.exception
 import dns.zone
 import dns.resolver
+import dns.asyncresolver
 from tqdm import tqdm
 from colorama import Fore
 from optparse import OptionParser
+from aiohttp.abc import AbstractResolver
 from aiohttp.resolver import AsyncResolver
-from itertools import islice
-from difflib import SequenceMatcher
 import threading
+import multiprocessing
+import urllib.parse
+import concurrent.futures
+import collections
 
 __version__ = '0.0.29'
 
@@ -69,157 +79,1389 @@ logger.setLevel(logging.INFO)
 ssl.match_hostname = lambda cert, hostname: True
 
 
-# 只采用了递归，速度非常慢，在优化完成前不建议开启
-# TODO:优化DNS查询，递归太慢了
 class DNSQuery(object):
-    def __init__(self, root_domain, subs, suffix):
+    """
+    Find subdomains in the SOA, AAAA, TXT and MX records of the subdomains
+    Breadth first: the names found on one level are queried on the next one, every name once
+    """
+    record_types = ('SOA', 'AAAA', 'TXT', 'MX')
+    hostname = re.compile(r'^(([a-z0-9]+(-[a-z0-9]+)*\.)+[a-z]{2,}\.?)$')
+
+    def __init__(self, root_domain, subs, suffix, query, scheduler):
         # root domain
         self.suffix = suffix
-        self.sub_domains = []
-        if root_domain:
-            self.sub_domains.append(root_domain)
+        self.root_domain = root_domain
+        self.subs = subs
+        # query(name, rdtype) coroutine, the DNS cache of the scan
+        self.query = query
+        # runs the lookups within the concurrency limit of the scan
+        self.scheduler = scheduler
+        self.visited = set()
 
-        for sub in subs:
-            sub = ''.join(sub.rsplit(suffix, 1)).rstrip('.')
-            self.sub_domains.append(f'{sub}.{suffix}')
-
-    def dns_query(self):
-        final_list = []
-        soa = aaaa = txt = mx = []
-        for subdomain in self.sub_domains:
-            try:
-                soa = []
-                q_soa = dns.resolver.resolve(subdomain, 'SOA')
-                for a in q_soa:
-                    soa.append(str(a.rname).strip('.'))
-                    soa.append(str(a.mname).strip('.'))
-            except Exception as e:
-                logger.warning(f'Query failed. {str(e)}')
-            try:
-                aaaa = []
-                q_aaaa = dns.resolver.resolve(subdomain, 'AAAA')
-                aaaa = [str(a.address).strip('.') for a in q_aaaa]
-            except Exception as e:
-                logger.warning(f'Query failed. {str(e)}')
-            try:
-                txt = []
-                q_txt = dns.resolver.resolve(subdomain, 'TXT')
-                txt = [t.strings[0].decode('utf-8').strip('.') for t in q_txt]
-            except Exception as e:
+    @staticmethod
+    def record_names(rdtype, answer):
+        if rdtype == 'SOA':
+            return [name for a in answer for name in (str(a.rname).strip('.'), str(a.mname).strip('.'))]
+        if rdtype == 'AAAA':
+            return [str(a.address).strip('.') for a in answer]
+        if rdtype == 'TXT':
+            return [t.strings[0].decode('utf-8').strip('.') for t in answer]
+        return [str(m.exchange).strip('.') for m in answer]
+
+    async def record(self, subdomain, rdtype, found):
+        """
+        Query one record type of a name
+        :param subdomain:
+        :param rdtype:
+        :param found: collects the names in the records
+        :return:
+        """
+        try:
+            names = self.record_names(rdtype, await self.query(subdomain, rdtype))
+        except Exception as e:
+            # most names have no such record
+            if DNSCache.is_negative(e):
+                logger.debug(f'Query failed. {str(e)}')
+            else:
                 logger.warning(f'Query failed. {str(e)}')
-            try:
-                mx = []
-                q_mx = dns.resolver.resolve(subdomain, 'MX')
-                mx = [str(m.exchange).strip('.') for m in q_mx]
-            except Exception as e:
-                logger.warning('Query failed. {e}'.format(e=str(e)))
-            domain_set = soa + aaaa + txt + mx
-            domain_list = [i for i in domain_set]
-            for p in domain_set:
-                re_domain = re.findall(r'^(([a-z0-9]+(-[a-z0-9]+)*\.)+[a-z]{2,}\.?)$', p)
-                if len(re_domain) > 0 and subdomain in re_domain[0][0]:
-                    continue
-                else:
-                    domain_list.remove(p)
-            final_list = domain_list + final_list
-        # 递归调用，在子域名的dns记录中查找新的子域名
-        recursive = []
-        # print("before: {0}".format(final_list))
-        # print("self.sub_domain: {0}".format(self.sub_domains))
-        final_list = list(set(final_list).difference(set(self.sub_domains)))
-        # print("after: {0}".format(final_list))
-        if final_list:
-            d = DNSQuery('', final_list, self.suffix)
-            recursive = d.dns_query()
-        return final_list + recursive
+            return
+        for name in names:
+            match = self.hostname.match(name)
+            if match is not None and subdomain in match.group(1):
+                found.add(name)
+
+    def unvisited(self, names):
+        for name in names:
+            if name not in self.visited:
+                self.visited.add(name)
+                yield name
+
+    async def dns_query(self):
+        """
+        :return: names found in the records, level by level
+        """
+        subs = (''.join(sub.rsplit(self.suffix, 1)).rstrip('.') for sub in self.subs)
+        level = itertools.chain([self.root_domain] if self.root_domain else [], (f'{sub}.{self.suffix}' for sub in subs))
+        final_list = []
+        while True:
+            found = set()
+            # every record type of every name of the level at once, each query takes a slot of the budget
+            await self.scheduler.run(self.record(name, rdtype, found)
+                                     for name in self.unvisited(level) for rdtype in self.record_types)
+            # 在子域名的dns记录中查找新的子域名, only the names of the domain are followed
+            level = sorted(name for name in found if name not in self.visited and name.endswith(f'.{self.suffix}'))
+            if not level:
+                return final_list
+            final_list.extend(level)
 
 
 class DNSTransfer(object):
-    def __init__(self, domain):
-        self.domain = domain
+    """
+    Zone transfer, tried against every IP of every nameserver of the domain at once
+    Zones are often transferable from a secondary only, and a hung nameserver must not hold up the others
+    """
 
-    def transfer_info(self):
-        ret_zones = list()
+    def __init__(self, domain, query, loop, timeout=2, lifetime=60):
+        self.domain = domain
+        # query(name, rdtype) coroutine, the DNS cache of the scan
+        self.query = query
+        self.loop = loop
+        # deadline of every read, and of the whole transfer
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.names = set()
+
+    async def nameserver_ips(self):
         try:
-            nss = dns.resolver.resolve(self.domain, 'NS')
-            nameservers = [str(ns) for ns in nss]
-            ns_addr = dns.resolver.resolve(nameservers[0], 'A')
-            # dnspython 的 bug，需要设置 lifetime 参数
-            zones = dns.zone.from_xfr(dns.query.xfr(ns_addr, self.domain, relativize=False, timeout=2, lifetime=2),
-                                      check_origin=False)
-            names = zones.nodes.keys()
-            for n in names:
-                subdomain = ''
-                for t in range(0, len(n) - 1):
-                    if subdomain != '':
-                        subdomain += '.'
-                    subdomain += str(n[t].decode())
-                if subdomain != self.domain:
-                    ret_zones.append(subdomain)
-            return ret_zones
-        except BaseException:
+            nss = await self.query(self.domain, 'NS')
+        except Exception:
             return []
+        nameservers = [str(ns.target).rstrip('.') for ns in nss]
+        answers = await asyncio.gather(*(self.query(ns, 'A') for ns in nameservers), return_exceptions=True)
+        ips = []
+        for ns, answer in zip(nameservers, answers):
+            if not isinstance(answer, Exception):
+                ips.extend((ns, r.host) for r in answer)
+        return ips
+
+    def xfr(self, ns, ip, found):
+        """
+        Stream the names out of the transfer as the messages arrive, runs in a thread
+        :param ns:
+        :param ip:
+        :param found: called on the loop with the names of every message
+        :return: count of the names
+        """
+        count = 0
+        try:
+            for message in dns.query.xfr(ip, self.domain, relativize=False, timeout=self.timeout,
+                                         lifetime=self.lifetime):
+                names = [rrset.name.to_text(omit_final_dot=True).lower() for rrset in message.answer]
+                count += len(names)
+                self.loop.call_soon_threadsafe(found, names)
+        except Exception as e:
+            logger.debug(f'AXFR {self.domain} from {ns}({ip}) failed: {e!r}')
+        if count:
+            logger.warning(f'DNS Transfer Vulnerability found in {self.domain} at {ns}({ip})!')
+        return count
+
+    async def transfer_info(self, found=None):
+        """
+        :param found: called with every new name as it arrives
+        :return: names of the zone
+        """
+
+        def on_names(names):
+            for name in names:
+                # the apex and the wildcard are no subdomains
+                if name in self.names or name == self.domain or name.startswith('*'):
+                    continue
+                self.names.add(name)
+                if found is not None:
+                    found(name)
+
+        ips = await self.nameserver_ips()
+        await asyncio.gather(*(self.loop.run_in_executor(None, self.xfr, ns, ip, on_names) for ns, ip in ips))
+        return sorted(self.names)
 
 
 class CAInfo(object):
-    def __init__(self, domain):
-        self.domain = domain
+    """
+    subjectAltNames of the certificates served by the live hosts of the scan
+    Handshakes run concurrently with SNI, a certificate served by many hosts is read once
+    """
 
-    def dns_resolve(self):
-        padding_domain = 'www.' + self.domain
-        # loop = asyncio.get_event_loop()
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        resolver = aiodns.DNSResolver(loop=loop)
-        f = resolver.query(padding_domain, 'A')
-        result = loop.run_until_complete(f)
-        return result[0].host
-
-    def get_cert_info_by_ip(self, ip):
-        s = socket.socket()
-        s.settimeout(2)
+    def __init__(self, domain, limit=50, timeout=2):
+        self.domain = domain
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(limit)
         base_dir = os.path.dirname(os.path.abspath(__file__))
-        cert_path = base_dir + '/cacert.pem'
-        connect = ssl.wrap_socket(s, cert_reqs=ssl.CERT_REQUIRED, ca_certs=cert_path)
-        connect.settimeout(2)
-        connect.connect((ip, 443))
-        cert_data = connect.getpeercert().get('subjectAltName')
-        return cert_data
-
-    def get_ca_domain_info(self):
-        domain_list = list()
+        self.context = ssl.create_default_context(cafile=base_dir + '/cacert.pem')
+        # the names of a certificate are wanted, not whether it is valid for the host
+        self.context.check_hostname = False
+        self.hosts = set()
+        self.fingerprints = set()
+        self.handshakes = 0
+
+    async def get_cert(self, host, ip):
+        """
+        TLS handshake with ip, host as SNI
+        :param host:
+        :param ip:
+        :return: DER certificate, decoded certificate
+        """
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, 443, ssl=self.context, server_hostname=host),
+                                           self.timeout)
+        try:
+            ssl_object = writer.get_extra_info('ssl_object')
+            return ssl_object.getpeercert(binary_form=True), ssl_object.getpeercert()
+        finally:
+            writer.close()
+
+    async def get_subdomains(self, host, ip):
+        """
+        Subdomains in the certificate of host, once per host and once per certificate
+        :param host:
+        :param ip:
+        :return:
+        """
+        if host in self.hosts:
+            return []
+        self.hosts.add(host)
+        async with self.slots:
+            self.handshakes += 1
+            try:
+                der, cert = await self.get_cert(host, ip)
+            except (OSError, asyncio.TimeoutError, ValueError):
+                return []
+        fingerprint = hashlib.sha256(der).digest()
+        if fingerprint in self.fingerprints:
+            return []
+        self.fingerprints.add(fingerprint)
+        subs = []
+        for kind, hostname in cert.get('subjectAltName', ()):
+            if kind == 'DNS' and not hostname.startswith('*') and hostname.lower().endswith(f'.{self.domain}'):
+                subs.append(hostname.lower())
+        return subs
+
+
+class CompiledDict(object):
+    """
+    Precompiled subdomain dict
+    Header: magic, version, sha256 of the source dicts, label count
+    Body: deduplicated and expanded labels separated by newlines
+    The file is memory mapped, so processes on one host share the page cache
+    """
+    magic = b'ESDD'
+    version = 1
+    header = struct.Struct('!4sH32sQ')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.digest, self.count = self.header.unpack_from(self.mm)
+        if magic != self.magic or version != self.version:
+            self.mm.close()
+            raise ValueError(f'Not a compiled dict: {path}')
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.iter_shard(0, 1)
+
+    def iter_shard(self, index, count):
+        """
+        Labels of one shard, only the selected labels are decoded
+        :param index:
+        :param count:
+        :return:
+        """
+        mm = self.mm
+        pos = self.header.size
+        end = len(mm)
+        while pos < end:
+            nl = mm.find(b'\n', pos)
+            if nl == -1:
+                nl = end
+            label = mm[pos:nl]
+            if count == 1 or zlib.crc32(label) % count == index:
+                yield label.decode('utf-8')
+            pos = nl + 1
+
+    def shard_size(self, index, count):
+        """
+        Count of the labels of one shard, without decoding them
+        :param index:
+        :param count:
+        :return:
+        """
+        if count == 1:
+            return self.count
+        mm = self.mm
+        pos = self.header.size
+        end = len(mm)
+        size = 0
+        while pos < end:
+            nl = mm.find(b'\n', pos)
+            if nl == -1:
+                nl = end
+            if zlib.crc32(mm[pos:nl]) % count == index:
+                size += 1
+            pos = nl + 1
+        return size
+
+    def close(self):
+        self.mm.close()
+
+    @staticmethod
+    def source_digest(paths):
+        """
+        Content hash of the source dicts, used for invalidation
+        :param paths:
+        :return:
+        """
+        h = hashlib.sha256(str(CompiledDict.version).encode())
+        for path in paths:
+            h.update(path.encode('utf-8'))
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+        return h.digest()
+
+    @classmethod
+    def compile(cls, path, digest, labels):
+        """
+        Write labels to a compiled dict, atomically replacing the old one
+        :param path:
+        :param digest:
+        :param labels: iterable of labels, deduplicated here
+        :return: count of labels
+        """
+        seen = set()
+        count = 0
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.header.pack(cls.magic, cls.version, digest, 0))
+            for label in labels:
+                if label in seen:
+                    continue
+                seen.add(label)
+                if count:
+                    f.write(b'\n')
+                f.write(label.encode('utf-8'))
+                count += 1
+            f.seek(0)
+            f.write(cls.header.pack(cls.magic, cls.version, digest, count))
+        os.replace(tmp_path, path)
+        return count
+
+
+class ResolutionStore(object):
+    """
+    Resolutions of every scan, keyed by FQDN
+    live: the name resolved on the last check, misses counts the NXDOMAIN checks in a row
+    reported: the name was in the output of the last run
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS records (
+            fqdn TEXT PRIMARY KEY,
+            domain TEXT NOT NULL,
+            ips TEXT,
+            ttl INTEGER,
+            live INTEGER NOT NULL,
+            misses INTEGER NOT NULL DEFAULT 0,
+            first_seen REAL,
+            last_seen REAL,
+            last_checked REAL NOT NULL,
+            reported INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS records_domain ON records (domain, live);
+    '''
+    upsert = '''
+        INSERT INTO records (fqdn, domain, ips, ttl, live, misses, first_seen, last_seen, last_checked)
+        VALUES (?, ?, ?, ?, ?, 1 - ?, ?, ?, ?)
+        ON CONFLICT (fqdn) DO UPDATE SET
+            ips = CASE WHEN excluded.live THEN excluded.ips ELSE records.ips END,
+            ttl = CASE WHEN excluded.live THEN excluded.ttl ELSE records.ttl END,
+            live = excluded.live,
+            misses = CASE WHEN excluded.live THEN 0 ELSE records.misses + 1 END,
+            first_seen = COALESCE(records.first_seen, excluded.first_seen),
+            last_seen = COALESCE(excluded.last_seen, records.last_seen),
+            last_checked = excluded.last_checked
+    '''
+    # rows buffered before they are written in one transaction
+    batch_size = 10000
+    # NXDOMAIN names are reprobed after reprobe_days * 2 ** (misses - 1) days, at most 64 times longer
+    max_backoff = 6
+
+    def __init__(self, path, domain):
+        self.path = path
+        self.domain = domain
+        # workers of the same scan write to the store concurrently
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.executescript(self.schema)
+        self.pending = []
+
+    def observe(self, fqdn, ips, ttl):
+        """
+        Record the answer of a name, ips is None for NXDOMAIN
+        :param fqdn:
+        :param ips:
+        :param ttl:
+        :return:
+        """
+        now = time.time()
+        live = int(ips is not None)
+        self.pending.append((fqdn, self.domain, ','.join(ips) if live else None, ttl, live, live,
+                             now if live else None, now if live else None, now))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.executemany(self.upsert, self.pending)
+        self.pending = []
+
+    def live(self):
+        """
+        Names which resolved on their last check
+        :return: set of FQDNs
+        """
+        rows = self.conn.execute('SELECT fqdn FROM records WHERE domain = ? AND live = 1', (self.domain,))
+        return {fqdn for fqdn, in rows}
+
+    def resting(self, reprobe_days):
+        """
+        NXDOMAIN names which are not due for a reprobe yet
+        :param reprobe_days: reprobe interval after the first NXDOMAIN
+        :return: set of FQDNs
+        """
+        rows = self.conn.execute(
+            'SELECT fqdn FROM records WHERE domain = ? AND live = 0 '
+            'AND last_checked + ? * (1 << MIN(misses - 1, ?)) > ?',
+            (self.domain, reprobe_days * 86400, self.max_backoff, time.time()))
+        return {fqdn for fqdn, in rows}
+
+    def diff(self, current, since):
+        """
+        Compare the results with the last run and mark them as reported
+        A name of the last run only counts as removed if it was checked since the scan started,
+        names of other dict shards are left alone
+        :param current: FQDNs found by this run
+        :param since: start time of this run
+        :return: added, removed
+        """
+        self.flush()
+        rows = self.conn.execute('SELECT fqdn, last_checked FROM records WHERE domain = ? AND reported = 1',
+                                 (self.domain,))
+        previous = {}
+        for fqdn, last_checked in rows:
+            previous[fqdn] = last_checked
+        added = sorted(fqdn for fqdn in current if fqdn not in previous)
+        removed = sorted(fqdn for fqdn, last_checked in previous.items()
+                         if fqdn not in current and last_checked >= since)
+        with self.conn:
+            self.conn.executemany('UPDATE records SET reported = 1 WHERE fqdn = ?', ((f,) for f in added))
+            self.conn.executemany('UPDATE records SET reported = 0 WHERE fqdn = ?', ((f,) for f in removed))
+        return added, removed
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class ResultSink(object):
+    """
+    Results appended to a JSON lines file as they are found
+    A removed result is a line with removed set, the last line of a name wins.
+    Names answered by the wildcard are lines with candidate set to the dict shard, RSC
+    compares them and a resumed scan reads them back.
+    The file is synced every fsync_interval seconds, a crash loses at most that much.
+    """
+    fsync_interval = 5
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.fp = open(path, 'a' if append else 'w', encoding='utf-8', buffering=1 << 16)
+        self.dirty = False
+        if append and self.fp.tell():
+            # end the torn last line of the interrupted scan
+            with open(path, 'rb') as fp:
+                fp.seek(-1, os.SEEK_END)
+                if fp.read(1) != b'\n':
+                    self.fp.write('\n')
+
+    def write(self, name, ips, phase):
+        self.fp.write(json.dumps({'name': name, 'ips': ips, 'phase': phase, 'time': round(time.time(), 3)}) + '\n')
+        self.dirty = True
+
+    def remove(self, name):
+        self.fp.write(json.dumps({'name': name, 'removed': True, 'time': round(time.time(), 3)}) + '\n')
+        self.dirty = True
+
+    def candidates(self, names, shard):
+        for name in names:
+            self.fp.write(json.dumps({'name': name, 'candidate': shard}) + '\n')
+        self.dirty = True
+
+    def sync(self):
+        if not self.dirty:
+            return
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.dirty = False
+
+    def close(self):
+        self.sync()
+        self.fp.close()
+
+    @staticmethod
+    def read(path, field='ips'):
+        """
+        Results of a sink file, the one of a crashed scan too
+        :param path:
+        :param field: ips, or phase for the sources of the results
+        :return: dict of name -> ips
+        """
+        results = {}
+        with open(path, encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn last line of a crashed scan
+                    continue
+                if 'candidate' in record:
+                    continue
+                if record.get('removed'):
+                    results.pop(record['name'], None)
+                else:
+                    results[record['name']] = record.get(field)
+        return results
+
+    @staticmethod
+    def read_candidates(path):
+        """
+        RSC candidates of a sink file in the order they were found
+        :param path:
+        :return: dict of dict shard -> names
+        """
+        candidates = collections.defaultdict(list)
+        with open(path, encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'candidate' in record:
+                    candidates[tuple(record['candidate'])].append(record['name'])
+        return candidates
+
+
+ARecord = collections.namedtuple('ARecord', ['host', 'ttl'])
+
+
+class UDPResolver(asyncio.DatagramProtocol):
+    """
+    Minimal DNS client for A records over one UDP socket
+    Queries are multiplexed by random transaction ids and built from precomputed
+    per-suffix templates, only the A answers are parsed.
+    Errors are raised as aiodns.error.DNSError with the c-ares codes,
+    so query() handles both engines the same way.
+    """
+    header = struct.Struct('!HHHHHH')
+    rr = struct.Struct('!HHIH')
+
+    def __init__(self, nameserver, loop=None, timeout=3, port=53):
+        self.nameserver = (nameserver, port)
+        self.loop = loop or asyncio.get_event_loop()
+        self.timeout = timeout
+        self.transport = None
+        self.opening = None
+        # transaction id -> (future, question, deadline), in deadline order
+        self.pending = {}
+        self.sweeper = None
+        # suffix -> encoded suffix labels + QTYPE A + QCLASS IN
+        self.suffixes = {}
+
+    def connection_made(self, transport):
+        sock = transport.get_extra_info('socket')
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        except OSError:
+            pass
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.opening = None
+        for fut, _, _ in self.pending.values():
+            if not fut.done():
+                fut.set_exception(aiodns.error.DNSError(11, 'Could not contact DNS servers'))
+        self.pending.clear()
+
+    def error_received(self, exc):
+        logger.debug(f'@{self.nameserver[0]} udp error: {exc}')
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        txid = (data[0] << 8) | data[1]
+        waiter = self.pending.get(txid)
+        if waiter is None:
+            return
+        fut, question, _ = waiter
+        # the question must be echoed back, otherwise it is a stale or spoofed answer
+        if data[12:12 + len(question)] != question:
+            return
+        del self.pending[txid]
+        if not fut.done():
+            fut.set_result(data)
+
+    @staticmethod
+    def encode_label(label):
+        label = label.encode('idna')
+        if not 0 < len(label) < 64:
+            raise ValueError(f'DNS labels are 1 to 63 bytes, not {len(label)}')
+        return bytes([len(label)]) + label
+
+    def encode_question(self, host):
+        """
+        Encode the question section from the cached suffix template
+        A label the wire format can not hold raises ValueError, it must not reach the server
+        :param host:
+        :return:
+        """
+        label, _, suffix = host.partition('.')
+        encoded = self.suffixes.get(suffix)
+        if encoded is None:
+            labels = suffix.split('.')
+            if labels[-1] == '':
+                # the root, www.example.com. or www.
+                labels.pop()
+            encoded = b''.join(self.encode_label(l) for l in labels)
+            encoded = self.suffixes[suffix] = encoded + b'\x00\x00\x01\x00\x01'
+        question = self.encode_label(label) + encoded
+        # 255 bytes of name, the type and class follow it
+        if len(question) > 259:
+            raise ValueError(f'DNS names are at most 255 bytes: {host}')
+        return question
+
+    @staticmethod
+    def skip_name(data, offset):
+        while True:
+            length = data[offset]
+            if length >= 0xc0:
+                return offset + 2
+            if length == 0:
+                return offset + 1
+            offset += length + 1
+
+    def parse(self, data, question_len):
+        """
+        Parse the A answers of a response
+        :param data:
+        :param question_len:
+        :return: list of ARecord
+        """
+        _, flags, _, ancount, _, _ = self.header.unpack_from(data)
+        rcode = flags & 0xf
+        if rcode == 3:
+            raise aiodns.error.DNSError(4, 'Domain name not found')
+        if rcode == 2:
+            raise aiodns.error.DNSError(3, 'Server failed')
+        if rcode == 5:
+            raise aiodns.error.DNSError(6, 'Query refused')
+        if rcode != 0:
+            raise aiodns.error.DNSError(10, 'Misformatted DNS reply')
+        records = []
+        offset = 12 + question_len
+        try:
+            for _ in range(ancount):
+                offset = self.skip_name(data, offset)
+                rtype, _, ttl, rdlength = self.rr.unpack_from(data, offset)
+                offset += self.rr.size
+                if rtype == 1 and rdlength == 4:
+                    records.append(ARecord(socket.inet_ntoa(data[offset:offset + 4]), ttl))
+                offset += rdlength
+        except (IndexError, struct.error):
+            raise aiodns.error.DNSError(10, 'Misformatted DNS reply')
+        if not records:
+            raise aiodns.error.DNSError(1, 'DNS server returned answer with no data')
+        return records
+
+    def sweep(self):
+        """
+        Expire timed out queries
+        One periodic timer instead of one timer per query, the pending dict is
+        in deadline order so the scan stops at the first live query
+        :return:
+        """
+        now = self.loop.time()
+        expired = []
+        for txid, (fut, _, deadline) in self.pending.items():
+            if deadline > now:
+                break
+            expired.append(txid)
+        for txid in expired:
+            fut = self.pending.pop(txid)[0]
+            if not fut.done():
+                fut.set_exception(aiodns.error.DNSError(12, 'Timeout while contacting DNS servers'))
+        if self.pending:
+            self.sweeper = self.loop.call_later(min(self.timeout, 0.5), self.sweep)
+        else:
+            self.sweeper = None
+
+    async def query(self, host, qtype):
+        if qtype != 'A':
+            raise ValueError(f'UDP engine only supports A records, not {qtype}')
+        if self.transport is None:
+            if self.opening is None:
+                self.opening = asyncio.ensure_future(
+                    self.loop.create_datagram_endpoint(lambda: self, remote_addr=self.nameserver))
+            try:
+                await asyncio.shield(self.opening)
+            except OSError:
+                self.opening = None
+                raise aiodns.error.DNSError(11, 'Could not contact DNS servers')
         try:
-            ip = self.dns_resolve()
-            cert_data = self.get_cert_info_by_ip(ip)
+            question = self.encode_question(host.lower())
+        except (UnicodeError, ValueError):
+            raise aiodns.error.DNSError(8, 'Misformatted domain name')
+        # unpredictable ids, the socket keeps one source port for all queries
+        txid = random.getrandbits(16)
+        while txid in self.pending:
+            txid = random.getrandbits(16)
+        fut = self.loop.create_future()
+        self.pending[txid] = (fut, question, self.loop.time() + self.timeout)
+        if self.sweeper is None:
+            self.sweeper = self.loop.call_later(min(self.timeout, 0.5), self.sweep)
+        # RD flag set, one question
+        self.transport.sendto(self.header.pack(txid, 0x0100, 1, 0, 0, 0) + question)
+        try:
+            data = await fut
+        finally:
+            if self.pending.get(txid, (None,))[0] is fut:
+                del self.pending[txid]
+        return self.parse(data, len(question))
+
+    def close(self):
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+            self.sweeper = None
+        if self.transport is not None:
+            self.transport.close()
+
+
+class PooledServer(object):
+    """
+    A DNS server of the resolver pool with its AIMD window and stats
+    """
+
+    def __init__(self, address, resolver, window):
+        self.address = address
+        self.resolver = resolver
+        # dnspython resolver of the server for the record types other than A, created on first use
+        self.records_resolver = None
+        # in-flight limit, slow start until the first congestion signal
+        self.window = window
+        self.ssthresh = float('inf')
+        self.inflight = 0
+        self.last_decrease = 0
+        self.quarantined_until = 0
+        self.quarantine_reason = None
+        # servfails counts every error answer of the server, REFUSED and malformed replies too
+        self.sent = self.ok = self.nx = self.timeouts = self.servfails = 0
+        # samples of the current health period
+        self.period_ok = self.period_errors = 0
+        self.since_canary = 0
+
+    def stats(self):
+        return {
+            'server': self.address,
+            'window': int(self.window),
+            'inflight': self.inflight,
+            'sent': self.sent,
+            'ok': self.ok,
+            'nx': self.nx,
+            'timeouts': self.timeouts,
+            'servfails': self.servfails,
+            'quarantined': self.quarantine_reason,
+        }
+
+
+class ResolverPool(object):
+    """
+    Spread queries over many DNS servers
+    Every server gets its own AIMD window of in-flight queries: it grows on
+    answers and halves on timeouts and SERVFAILs. Servers that time out too
+    often are quarantined for a while, servers that answer names which must
+    not exist are quarantined for the rest of the scan.
+    """
+    # errors that mean the server is overloaded or broken:
+    # FORMERR, SERVFAIL, NOTIMP, REFUSED, malformed reply, unreachable, timeout
+    congestion_errors = (2, 3, 5, 6, 10, 11, 12)
+    timeout_errors = (11, 12)
+
+    def __init__(self, servers, factory, loop, window=100, max_window=5000, timeout=3, quarantine_time=60,
+                 canary_interval=2000):
+        self.loop = loop
+        self.max_window = max_window
+        self.timeout = timeout
+        self.quarantine_time = quarantine_time
+        self.canary_interval = canary_interval
+        # suffix whose random labels must be NXDOMAIN, None when unknown or wildcard
+        self.canary_domain = None
+        self.servers = [PooledServer(s, factory([s]), window) for s in servers]
+        self.waiters = collections.deque()
+
+    def healthy(self, now=None):
+        now = self.loop.time() if now is None else now
+        return [s for s in self.servers if s.quarantined_until <= now]
+
+    def pick(self):
+        """
+        Healthy server with the most free window, None if every window is full
+        :return:
+        """
+        servers = self.healthy() or self.servers
+        best, best_free = None, 0
+        for server in servers:
+            free = server.window - server.inflight
+            if free >= 1 and free > best_free:
+                best, best_free = server, free
+        return best
+
+    async def acquire(self):
+        while True:
+            server = self.pick()
+            if server is not None:
+                return server
+            waiter = self.loop.create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # pass the wakeup on, it was meant for a free slot
+                if waiter.done() and not waiter.cancelled():
+                    self.release()
+                raise
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def quarantine(self, address, reason, duration=None):
+        """
+        Stop sending queries to a server
+        :param address:
+        :param reason:
+        :param duration: seconds, forever if None
+        :return:
+        """
+        for server in self.servers:
+            if server.address == address:
+                server.quarantined_until = float('inf') if duration is None else self.loop.time() + duration
+                server.quarantine_reason = reason
+                server.window = 1
+                logger.warning(f'@{address} quarantined: {reason}')
+        self.release()
+
+    def on_answer(self, server):
+        server.period_ok += 1
+        if server.window < server.ssthresh:
+            server.window += 1
+        else:
+            server.window += 1 / server.window
+        server.window = min(server.window, self.max_window)
+        server.since_canary += 1
+        if self.canary_domain is not None and server.since_canary >= self.canary_interval:
+            server.since_canary = 0
+            asyncio.ensure_future(self.canary(server))
+
+    def on_congestion(self, server):
+        server.period_errors += 1
+        now = self.loop.time()
+        # decrease once per timeout period, the whole window fails together
+        if now - server.last_decrease > self.timeout:
+            server.last_decrease = now
+            server.ssthresh = server.window = max(server.window / 2, 1)
+        samples = server.period_ok + server.period_errors
+        if samples >= 100:
+            if server.period_errors > samples / 2:
+                self.quarantine(server.address, f'{server.period_errors}/{samples} errors',
+                                duration=self.quarantine_time)
+            server.period_ok = server.period_errors = 0
+
+    async def canary(self, server):
+        """
+        Query a random label which must not exist, answers mean a hijacking server
+        :param server:
+        :return:
+        """
+        host = 'feei-esd-canary-{r}.{d}'.format(r=random.randint(0, 99999999), d=self.canary_domain)
+        try:
+            ret = await server.resolver.query(host, 'A')
+        except Exception:
+            return
+        if ret and server.quarantined_until != float('inf'):
+            self.quarantine(server.address, f'answered nonexistent {host} with {[r.host for r in ret]}')
+
+    async def query(self, host, qtype):
+        server = await self.acquire()
+        server.inflight += 1
+        server.sent += 1
+        try:
+            ret = await server.resolver.query(host, qtype)
+        except aiodns.error.DNSError as e:
+            if e.args[0] in self.congestion_errors:
+                if e.args[0] in self.timeout_errors:
+                    server.timeouts += 1
+                else:
+                    server.servfails += 1
+                self.on_congestion(server)
+            else:
+                server.nx += 1
+                self.on_answer(server)
+            raise
+        else:
+            server.ok += 1
+            self.on_answer(server)
+            return ret
+        finally:
+            server.inflight -= 1
+            self.release()
+
+    async def resolve(self, host, rdtype):
+        """
+        Resolve another record type than A with dnspython, within the windows of the pool
+        :param host:
+        :param rdtype:
+        :return: dnspython answer
+        """
+        server = await self.acquire()
+        server.inflight += 1
+        server.sent += 1
+        if server.records_resolver is None:
+            server.records_resolver = dns.asyncresolver.Resolver(configure=False)
+            server.records_resolver.nameservers = [server.address]
+            server.records_resolver.lifetime = self.timeout
+        try:
+            ret = await server.records_resolver.resolve(host, rdtype)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            server.nx += 1
+            self.on_answer(server)
+            raise
+        except dns.exception.Timeout:
+            server.timeouts += 1
+            self.on_congestion(server)
+            raise
+        except dns.resolver.NoNameservers:
+            # SERVFAIL, REFUSED or a malformed reply
+            server.servfails += 1
+            self.on_congestion(server)
+            raise
+        else:
+            server.ok += 1
+            self.on_answer(server)
+            return ret
+        finally:
+            server.inflight -= 1
+            self.release()
+
+    def summary(self):
+        healthy = self.healthy()
+        return f'dns {len(healthy)}/{len(self.servers)} window {int(sum(s.window for s in healthy))}'
+
+    def report(self):
+        for server in self.servers:
+            stats = server.stats()
+            logger.info(' '.join(f'{k}={v}' for k, v in stats.items()))
+
+
+class DNSCache(object):
+    """
+    Answers of one scan shared by all phases
+    Answers live for their TTL, NXDOMAIN and empty answers for negative_ttl.
+    Concurrent lookups of the same name share one query.
+    """
+
+    def __init__(self, resolver, loop, negative_ttl=300, max_ttl=3600):
+        self.resolver = resolver
+        self.loop = loop
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        # (host, qtype) -> (expires, answer, error)
+        self.entries = {}
+        # (host, qtype) -> future of the query on the wire
+        self.inflight = {}
+        self.purge_at = 10000
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def is_negative(error):
+        if isinstance(error, aiodns.error.DNSError):
+            # 1: no data, 4: domain name not found
+            return error.args[0] in (1, 4)
+        return isinstance(error, (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer))
+
+    def answer_ttl(self, answer):
+        rrset = getattr(answer, 'rrset', None)
+        if rrset is not None:
+            ttl = rrset.ttl
+        else:
+            ttl = min((r.ttl for r in answer), default=0)
+        return min(ttl, self.max_ttl)
+
+    def put(self, key, answer, error, ttl):
+        if ttl <= 0:
+            return
+        if len(self.entries) >= self.purge_at:
+            now = self.loop.time()
+            self.entries = {k: v for k, v in self.entries.items() if v[0] > now}
+            self.purge_at = max(2 * len(self.entries), 10000)
+        self.entries[key] = (self.loop.time() + ttl, answer, error)
+
+    async def fetch(self, host, qtype):
+        if qtype == 'A':
+            return await self.resolver.query(host, qtype)
+        # the other record types are resolved by dnspython on the servers of the pool, with its answer types
+        return await self.resolver.resolve(host, qtype)
+
+    async def query(self, host, qtype):
+        """
+        Resolve from the cache, or from the network once for all concurrent callers
+        :param host:
+        :param qtype:
+        :return: answer of the resolver
+        """
+        key = (host.lower(), qtype)
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, answer, error = entry
+            if expires > self.loop.time():
+                self.hits += 1
+                if error is not None:
+                    # do not grow the traceback of the cached error on every raise
+                    raise error.with_traceback(None)
+                return answer
+            del self.entries[key]
+        fut = self.inflight.get(key)
+        if fut is not None:
+            self.coalesced += 1
+            # a cancelled waiter must not cancel the query of the others
+            return await asyncio.shield(fut)
+
+        self.misses += 1
+        fut = self.loop.create_future()
+        # nobody may be waiting for the error
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.inflight[key] = fut
+        try:
+            answer = await self.fetch(host, qtype)
         except Exception as e:
-            return domain_list
+            if self.is_negative(e):
+                self.put(key, None, e, self.negative_ttl)
+            fut.set_exception(e)
+            raise
+        else:
+            self.put(key, answer, None, self.answer_ttl(answer))
+            fut.set_result(answer)
+            return answer
+        finally:
+            del self.inflight[key]
+            if not fut.done():
+                fut.cancel()
 
-        for domain_info in cert_data:
-            hostname = domain_info[1]
-            if not hostname.startswith('*') and hostname.endswith(self.domain):
-                domain_list.append(hostname)
+    def report(self):
+        logger.info(f'DNS cache: entries={len(self.entries)} hits={self.hits} misses={self.misses} '
+                    f'coalesced={self.coalesced}')
 
-        return domain_list
 
-    def get_subdomains(self):
-        subs = list()
-        subdomain_list = self.get_ca_domain_info()
-        for sub in subdomain_list:
-            subs.append(sub[:len(sub) - len(self.domain) - 1])
-        return subs
+class CachedResolver(AbstractResolver):
+    """
+    aiohttp resolver answering from the DNSCache of the scan
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        try:
+            records = await self.cache.query(host, 'A')
+        except aiodns.error.DNSError as e:
+            raise OSError(f'DNS lookup failed: {host} {e}')
+        return [{'hostname': host, 'host': r.host, 'port': port, 'family': socket.AF_INET, 'proto': 0,
+                 'flags': socket.AI_NUMERICHOST} for r in records]
+
+    async def close(self):
+        pass
+
 
-domain_domain_ips = []
+class LengthSimilarity(object):
+    """
+    Similarity of the cleaned html lengths
+    Exactly SequenceMatcher(None, a, b).real_quick_ratio(), which is all RSC ever used,
+    without building the b2j index of the baseline for every candidate
+    """
+    name = 'length'
+
+    @staticmethod
+    def fingerprint(html):
+        return len(html)
+
+    @staticmethod
+    def ratio(a, b):
+        return 2.0 * min(a, b) / (a + b) if a + b else 1.0
+
+    @staticmethod
+    def bands(fingerprint):
+        """
+        LSH buckets, similar fingerprints share at least one
+        A ratio above 2/3 means the lengths differ less than 2x, so their bit lengths differ by at most 1
+        """
+        b = fingerprint.bit_length()
+        return b, b + 1
+
+
+class SimhashSimilarity(object):
+    """
+    64-bit simhash over the words and tags of the cleaned html
+    The ratio is the share of equal bits, so pages with the same structure but other lengths still match
+    """
+    name = 'simhash'
+    bits = 64
+    tokens = re.compile(r'\w+')
+
+    def fingerprint(self, html):
+        weights = [0] * self.bits
+        for token, count in collections.Counter(self.tokens.findall(html)).items():
+            h = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'big')
+            for i in range(self.bits):
+                weights[i] += count if h >> i & 1 else -count
+        return sum(1 << i for i, w in enumerate(weights) if w > 0)
+
+    def ratio(self, a, b):
+        return 1.0 - bin(a ^ b).count('1') / self.bits
+
+    @staticmethod
+    def bands(fingerprint):
+        """
+        LSH buckets: the four 16-bit bands of the simhash
+        """
+        return tuple((i, fingerprint >> (16 * i) & 0xffff) for i in range(4))
+
+
+# --similarity engines
+similarity_engines = {
+    'length': LengthSimilarity,
+    'simhash': SimhashSimilarity,
+}
+
+
+class ResponseAnalyzer(object):
+    """
+    Response analysis of one domain, patterns compiled once
+    Picklable, it is shipped to the analysis pool with every response
+    """
+    label_chars = string.ascii_lowercase + string.digits + '-'
+
+    def __init__(self, domain, engine, response_filter=None):
+        self.domain = domain
+        self.suffix = f'.{domain}'.lower()
+        self.engine = engine
+        self.filters = tuple(response_filter.split(',')) if response_filter is not None else ()
+        self.host_pattern = re.compile(r'(?:[a-z\d-]+\.)+' + re.escape(domain), re.I)
+        # one pass drops whitespace and inline scripts
+        self.clean_pattern = re.compile(r'\s|<script\b(?![^>]*\bsrc\s*=)[^>]*>.*?</script\s*>', re.I | re.S)
+
+    def clean(self, html):
+        """
+        Drop whitespace and inline scripts
+        :param html:
+        :return:
+        """
+        return self.clean_pattern.sub('', html)
+
+    def hosts(self, html):
+        """
+        Hostnames of the domain in html
+        Searched for by their suffix instead of trying a pattern at every position, the labels are read backwards
+        Runs on the raw html, "contact a.example.com" is no "contacta.example.com"
+        :param html:
+        :return:
+        """
+        html = html.lower()
+        label_chars = self.label_chars
+        host_chars = label_chars + '.'
+        suffix = self.suffix
+        hosts = set()
+        end = 0
+        while True:
+            start = html.find(suffix, end)
+            if start == -1:
+                break
+            end = start + len(suffix)
+            # a.example.com.cn is no hostname of example.com
+            if end < len(html) and html[end] in label_chars:
+                continue
+            head = html[max(0, start - 253):start]
+            labels = head[len(head.rstrip(host_chars)):].lstrip('.-')
+            if labels:
+                hosts.add(labels + suffix)
+        return frozenset(hosts)
+
+    def match_host(self, text):
+        """
+        Hostname at the start of text
+        :param text:
+        :return:
+        """
+        match = self.host_pattern.match(text)
+        return match.group(0) if match is not None else None
+
+    def __call__(self, html, baseline_len, baseline_fingerprint):
+        """
+        Clean a response, collect the hostnames in it and compare it with the wildcard response
+        Cleaning is idempotent, a cleaned wildcard response gives the same result again
+        :param html:
+        :param baseline_len: length of the cleaned wildcard response
+        :param baseline_fingerprint: fingerprint of the cleaned wildcard response
+        :return: ratio, fingerprint, hostnames in the response, whether the response filter matched
+        """
+        hosts = self.hosts(html)
+        html = self.clean(html)
+        fingerprint = None
+        if len(html) == baseline_len:
+            ratio = 1
+        else:
+            fingerprint = self.engine.fingerprint(html)
+            ratio = round(self.engine.ratio(fingerprint, baseline_fingerprint), 3)
+        filtered = any(resp_filter in html for resp_filter in self.filters)
+        return ratio, fingerprint, hosts, filtered
+
+
+# results not sent by the heartbeat yet
+domain_domain_ips = collections.deque()
 task_flag = False
+
+
+class TaskSource(object):
+    """
+    Coroutines of one caller of the FairScheduler
+    """
+
+    def __init__(self, coros, done, progress=None):
+        self.coros = coros
+        self.done = done
+        self.progress = progress
+        self.running = 0
+        self.exhausted = False
+
+    def finish(self, exc=None):
+        if self.done.done():
+            return
+        if exc is not None:
+            self.done.set_exception(exc)
+        elif self.exhausted and self.running == 0:
+            self.done.set_result(None)
+
+
+class Watermark(object):
+    """
+    Highest position below which every task is finished
+    Tasks finish out of order, the ones past a gap are kept until it is closed.
+    """
+
+    def __init__(self, position=0):
+        self.position = position
+        self.finished = set()
+
+    def finish(self, index):
+        if index == self.position + 1:
+            self.position = index
+            while self.position + 1 in self.finished:
+                self.position += 1
+                self.finished.remove(self.position)
+        elif index > self.position:
+            self.finished.add(index)
+
+
+class FairScheduler(object):
+    """
+    Run coroutines of many callers with one in-flight budget
+    A fixed number of workers take the next coroutine from the callers in
+    round-robin, so a domain with a huge dict does not starve the others.
+    Workers exit when there is nothing left, no polling and no idle tasks.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.sources = collections.deque()
+        self.workers = 0
+
+    def next_task(self):
+        while self.sources:
+            source = self.sources.popleft()
+            if source.exhausted:
+                continue
+            try:
+                coro = next(source.coros)
+            except StopIteration:
+                source.exhausted = True
+                source.finish()
+                continue
+            except Exception as e:
+                # a failing dict or store, the caller gets the error instead of waiting forever
+                source.exhausted = True
+                source.finish(e)
+                continue
+            self.sources.append(source)
+            source.running += 1
+            return source, coro
+        return None, None
+
+    async def worker(self):
+        try:
+            while True:
+                source, coro = self.next_task()
+                if coro is None:
+                    return
+                try:
+                    await coro
+                except Exception as e:
+                    source.exhausted = True
+                    source.finish(e)
+                source.running -= 1
+                if source.progress is not None:
+                    source.progress.update(1)
+                source.finish()
+        finally:
+            self.workers -= 1
+
+    async def run(self, coros, progress=None):
+        """
+        Run the coroutines, return when all of them finished
+        :param coros: iterator of coroutines
+        :param progress: optional tqdm bar updated on every completion
+        :return:
+        """
+        source = TaskSource(iter(coros), asyncio.get_event_loop().create_future(), progress)
+        self.sources.append(source)
+        while self.workers < self.limit:
+            self.workers += 1
+            asyncio.ensure_future(self.worker())
+        await source.done
+
+
 class EnumSubDomain(threading.Thread):
+    # sources of the names discover() queues
+    frontier_sources = ('redirect', 'response', 'certificate', 'axfr')
+
     def __init__(self, domain, response_filter=None, dns_servers=None, skip_rsc=False, debug=False,
-                 split=None, proxy=None, multiresolve=False):
+                 split=None, proxy=None, multiresolve=False, wordlists=None, engine='aiodns', workers=1,
+                 incremental=False, reprobe_days=7, wildcard_probes=16, max_body=1048576, similarity='length',
+                 rsc_distinct=False, analysis_workers=None, resume=False, http_per_host=None):
         threading.Thread.__init__(self)
+        # arguments to create the same enumerator in worker processes
+        self.options = dict(domain=domain, response_filter=response_filter, skip_rsc=skip_rsc, debug=debug,
+                            split=split, proxy=proxy, wordlists=wordlists, engine=engine, incremental=incremental,
+                            reprobe_days=reprobe_days, max_body=max_body, similarity=similarity,
+                            rsc_distinct=rsc_distinct, analysis_workers=analysis_workers,
+                            http_per_host=http_per_host)
         self.project_directory = os.path.abspath(os.path.dirname(__file__))
+        # custom wordlists compiled together with subs.esd
+        self.wordlists = [os.path.abspath(w) for w in wordlists or []]
+        self.dict_cache_path = '{pd}/tmp/.subs.esdc'.format(pd=self.project_directory)
+        # resolutions of all scans
+        self.store_path = '{pd}/tmp/.esd.db'.format(pd=self.project_directory)
+        # results streamed as they are found
+        self.sink_path = '{pd}/tmp/.{d}.jsonl'.format(pd=self.project_directory, d=domain)
+        self.sink = None
+        # progress of the scan, removed when it completes
+        self.checkpoint_path = '{pd}/tmp/.{d}.checkpoint'.format(pd=self.project_directory, d=domain)
+        self.checkpoint_interval = 30
+        # continue from the checkpoint
+        self.resume = resume
+        self.only_similarity = False
+        self.store = None
+        # only re-check live names and the NXDOMAIN names due for a reprobe
+        self.incremental = incremental
+        self.reprobe_days = reprobe_days
         self.proxy = proxy
         self.data = {}
         self.domain = domain
         self.skip_rsc = skip_rsc
         self.split = split
+        # (index, count) of the dict shard to enumerate
+        self.shard = (0, 1)
+        if split is not None:
+            s = split.split('/')
+            self.shard = (int(s[0]) - 1, int(s[1]))
+        # processes to fan out the dict to
+        self.workers = workers
+        # in-flight budget -> FairScheduler, shared by all domains in batch mode
+        self.schedulers = {}
+        # compiled dict shared by all domains in batch mode
+        self.compiled_dict = None
+        self.worker_conns = {}
+        self.workers_done = None
+        # pipe to the parent process when running as a worker
+        self.result_conn = None
+        self.progress = True
+        # only one of the worker processes queries the root domain
+        self.query_root = True
+        # current phase, recorded with the results
+        self.phase = 'brute'
         self.multiresolve = multiresolve
         self.stable_dns_servers = ['119.29.29.29']
         if dns_servers is None:
@@ -232,8 +1474,20 @@ class EnumSubDomain(threading.Thread):
         random.shuffle(dns_servers)
         self.dns_servers = dns_servers
         self.resolver = None
+        # answers of this scan
+        self.cache = None
+        # HTTP session of the RSC phase
+        self.session = None
+        self.http_max_redirects = 10
+        # responses are read in chunks up to max_body bytes, larger ones are compared by their head
+        self.http_max_body = max_body
+        self.http_chunk_size = 16384
+        # bytes of the body head compared with the wildcard response before reading the rest
+        self.http_prefix_size = 1024
+        # aiodns or the built-in udp engine
+        self.engine = engine
         self.loop = asyncio.get_event_loop()
-        self.general_dicts = []
+        self.dict_count = 0
         # Mark whether the current domain name is a pan-resolved domain name
         self.is_wildcard_domain = False
         # Use a nonexistent domain name to determine whether
@@ -242,24 +1496,59 @@ class EnumSubDomain(threading.Thread):
         self.wildcard_sub3 = 'feei-esd-{random}.{random}'.format(random=random.randint(0, 9999))
         # There is no domain name DNS resolution IP
         self.wildcard_ips = []
+        # read-only set of the wildcard IPs checked by every answer
+        self.wildcard_index = frozenset()
+        # /24 subnets of the wildcard IPs as packed ints, answers in them are compared by RSC too
+        self.wildcard_subnets = frozenset()
+        # unindexed IPs in the wildcard subnets -> task of the probes confirming them
+        self.subnet_confirmations = {}
+        # names recorded in --skip-rsc mode although their IPs are in the wildcard subnets
+        self.subnet_suspects = 0
+        # random labels resolved to learn the wildcard IP pool
+        self.wildcard_probes = wildcard_probes
+        # parent zone below the apex -> task of its wildcard IPs, probed on first use
+        self.zone_wildcards = {}
         # No domain name response HTML
         self.wildcard_html = None
         self.wildcard_html_len = 0
         self.wildcard_html3 = None
         self.wildcard_html3_len = 0
-        # Subdomains that are consistent with IPs that do not have domain names
+        # (Content-Length, body head) of the wildcard responses
+        self.wildcard_fingerprint = None
+        self.wildcard_fingerprint3 = None
+        # Subdomains answered by the wildcard IPs, RSC only compares these
         self.wildcard_subs = []
         # Wildcard domains use RSC
         self.wildcard_domains = {}
-        # Corotines count
-        self.coroutine_count = None
         # 并发太高DNS Server的错误会大幅增加
         self.coroutine_count_dns = 5000
         self.coroutine_count_request = 100
+        # connections per IP, the candidates of a wildcard all connect to its IP,
+        # a lower limit than the requests in flight would cap the RSC of a single IP wildcard
+        self.http_limit_per_host = http_per_host or self.coroutine_count_request
+        self.coroutine_count_rs = 20
         # dnsaio resolve timeout
         self.resolve_timeout = 3
         # RSC ratio
         self.rsc_ratio = 0.8
+        self.similarity_engine = similarity_engines[similarity]()
+        self.response_analyzer = ResponseAnalyzer(self.domain, self.similarity_engine, response_filter)
+        # fingerprints of wildcard_html and wildcard_html3, computed once
+        self.wildcard_html_fps = None
+        # drop RSC results which are near duplicates of each other
+        self.rsc_distinct = rsc_distinct
+        if analysis_workers is None:
+            analysis_workers = min(4, os.cpu_count() or 1)
+        # processes analysing the responses, 0 analyses them on the event loop
+        self.analysis_workers = analysis_workers
+        self.analysis_pool = None
+        self.analysis_pool_owner = False
+        self.analysis_slots = None
+        # body hash -> task of the analysis of the response, least recently used first
+        self.response_cache = collections.OrderedDict()
+        self.response_cache_size = 4096
+        self.response_cache_hits = 0
+        self.response_cache_misses = 0
         self.remainder = 0
         self.count = 0
         # Request Header
@@ -281,87 +1570,439 @@ class EnumSubDomain(threading.Thread):
         if self.debug:
             logger.setLevel(logging.DEBUG)
         # collect redirecting domains and response domains
-        self.domains_rs = []
-        self.domains_rs_processed = []
+        # frontier: every name is queued once and checked while the other phases go on
+        # name -> source, one of frontier_sources
+        self.rs_seen = {}
+        self.rs_queue = None
+        self.rs_tasks = []
+        self.rs_count = 0
+        # queued names not checked yet, checkpointed
+        self.rs_pending = set()
+        # positions of the dict and of the wildcard_subs RSC compares, every entry before them is finished
+        self.dict_progress = Watermark()
+        self.rsc_progress = Watermark()
+        # worker shard -> progress, and the RSC candidates of the worker shards read back on resume
+        self.shard_progress = {}
+        self.shard_candidates = {}
+        # wildcard_subs already sent to the parent
+        self.progress_sent = 0
+        # certificates of the live hosts, their names go to the frontier
+        self.ca = None
+        self.cert_tasks = set()
         self.dns_query_errors = 0
 
-    def generate_general_dicts(self, line):
+    @staticmethod
+    def generate_general_dicts(line):
         """
-        Generate general subdomains dicts
+        Generate general subdomains dicts lazily
         :param line:
-        :return:
+        :return: generator of subdomains
         """
         # 根据RFC 1034/1035规定，域名中仅允许出现字母、数字和横杠（-）
         letter_count = line.count('{letter}')
         number_count = line.count('{number}')
-        letters = itertools.product(string.ascii_lowercase + '-', repeat=letter_count)
-        letters = [''.join(l) for l in letters]
-        numbers = itertools.product(string.digits, repeat=number_count)
-        numbers = [''.join(n) for n in numbers]
-        for l in letters:
-            iter_line = line.replace('{letter}' * letter_count, l)
+        # 只有连续的占位符才会被替换，否则保持原样只生成一次
+        if '{letter}' * letter_count not in line:
+            letter_count = 0
+        if '{number}' * number_count not in line:
+            number_count = 0
+        # Only labels shortened by the dash normalization can repeat, so only they are remembered
+        normalized = set()
+        for l in itertools.product(string.ascii_lowercase + '-', repeat=letter_count):
+            raw_line = line.replace('{letter}' * letter_count, ''.join(l)) if letter_count else line
             # 根据RFC 1034/1035规定，子域名的头部和尾部不允许出现横杠（-），中间不允许连续出现横杠（-）
-            iter_line = iter_line.strip('-')
+            iter_line = raw_line.strip('-')
             iter_line = re.sub(r'-+', '-', iter_line)
-            if iter_line != '':
-                self.general_dicts.append(iter_line)
-        number_dicts = []
-        for gd in self.general_dicts:
-            for n in numbers:
-                iter_line = gd.replace('{number}' * number_count, n)
-                number_dicts.append(iter_line)
-        if len(number_dicts) > 0:
-            return number_dicts
-        else:
-            return self.general_dicts
+            if iter_line == '':
+                continue
+            if iter_line != raw_line:
+                if iter_line in normalized:
+                    continue
+                normalized.add(iter_line)
+            if number_count:
+                for n in itertools.product(string.digits, repeat=number_count):
+                    yield iter_line.replace('{number}' * number_count, ''.join(n))
+            else:
+                yield iter_line
 
-    def load_sub_domain_dict(self):
+    def dict_paths(self):
         """
-        Load subdomains from files and dicts
+        Source dicts: subs.esd followed by the custom wordlists
         :return:
         """
-        dicts = []
         if self.debug:
             path = '{pd}/subs-test.esd'.format(pd=self.project_directory)
         else:
             path = '{pd}/subs.esd'.format(pd=self.project_directory)
-        with open(path, encoding='utf-8') as f:
-            for line in f:
-                line = line.strip().lower()
-                # skip comments and space
-                if '#' in line or line == '':
-                    continue
-                if '{letter}' in line or '{number}' in line:
-                    self.general_dicts = []
-                    dicts_general = self.generate_general_dicts(line)
-                    dicts += dicts_general
-                else:
-                    # compatibility other dicts
-                    line = line.strip('.')
-                    dicts.append(line)
-        dicts = list(set(dicts))
+        return [path] + self.wordlists
 
+    def iter_dict_sources(self):
+        """
+        Read and expand the source dicts lazily
+        :return: generator of subdomains
+        """
+        # plain lines are deduplicated exactly, expanded lines only against plain lines
+        plain = set()
+        for path in self.dict_paths():
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip().lower()
+                    # skip comments and space
+                    if '#' in line or line == '':
+                        continue
+                    if '{letter}' in line or '{number}' in line:
+                        yield from (d for d in self.generate_general_dicts(line) if d not in plain)
+                    else:
+                        # compatibility other dicts
+                        line = line.strip('.')
+                        if line in plain:
+                            continue
+                        plain.add(line)
+                        yield line
+
+    def compile_sub_domain_dict(self, digest=None):
+        """
+        Compile the source dicts into the binary dict cache
+        :param digest: content hash of the sources, computed if not given
+        :return: path of the compiled dict
+        """
+        if digest is None:
+            digest = CompiledDict.source_digest(self.dict_paths())
+        tmp_dir = self.project_directory + '/tmp'
+        if not os.path.isdir(tmp_dir):
+            os.mkdir(tmp_dir, 0o777)
+        count = CompiledDict.compile(self.dict_cache_path, digest, self.iter_dict_sources())
+        logger.info(f'Compiled {count} subs into {self.dict_cache_path}')
+        return self.dict_cache_path
+
+    def open_compiled_dict(self):
+        """
+        Open the binary dict cache, (re)compiling it when the sources changed
+        :return: CompiledDict or None if the cache is not usable
+        """
+        try:
+            digest = CompiledDict.source_digest(self.dict_paths())
+            if os.path.isfile(self.dict_cache_path):
+                compiled = CompiledDict(self.dict_cache_path)
+                if compiled.digest == digest:
+                    return compiled
+                compiled.close()
+                logger.info('Sub domain dict changed, recompile it')
+            return CompiledDict(self.compile_sub_domain_dict(digest))
+        except (OSError, ValueError) as e:
+            logger.warning(f'Compiled dict is not available, read the source dicts. {e}')
+            return None
+
+    def dict_size(self):
+        """
+        Count of the subdomains load_sub_domain_dict yields, from the compiled dict
+        :return: count, None if the dict is not compiled
+        """
+        compiled = self.compiled_dict if self.compiled_dict is not None else self.open_compiled_dict()
+        if compiled is None:
+            return None
+        try:
+            size = compiled.shard_size(*self.shard)
+        finally:
+            if compiled is not self.compiled_dict:
+                compiled.close()
+        return size + 1 if self.query_root else size
+
+    def load_sub_domain_dict(self, start=0):
+        """
+        Load subdomains from the compiled dict, or lazily from the source dicts
+        :param start: position to continue from, the entries up to it are counted but not loaded
+        :return: generator of subdomains
+        """
         # split dict
-        if self.split is not None:
-            s = self.split.split('/')
-            dicts_choose = int(s[0])
-            dicts_count = int(s[1])
-            dicts_every = int(math.ceil(len(dicts) / dicts_count))
-            dicts = [dicts[i:i + dicts_every] for i in range(0, len(dicts), dicts_every)][dicts_choose - 1]
-            logger.info(f'Sub domain dict split {dicts_count} and get {dicts_choose}st')
+        dicts_choose, dicts_count = self.shard
+        if dicts_count > 1:
+            logger.info(f'Sub domain dict split {dicts_count} and get {dicts_choose + 1}st')
+
+        # shards are picked by a stable hash of the label, so every process
+        # on every machine agrees on them whatever the dict order is
+        compiled = self.compiled_dict if self.compiled_dict is not None else self.open_compiled_dict()
+        if compiled is None:
+            dicts = (d for d in self.iter_dict_sources()
+                     if dicts_count == 1 or zlib.crc32(d.encode('utf-8')) % dicts_count == dicts_choose)
+        else:
+            dicts = compiled.iter_shard(dicts_choose, dicts_count)
+        self.dict_count = 0
+        try:
+            for d in dicts:
+                self.dict_count += 1
+                if self.dict_count > start:
+                    yield d
+        finally:
+            if compiled is not None and compiled is not self.compiled_dict:
+                compiled.close()
 
         # root domain
-        dicts.append('@')
+        if self.query_root:
+            self.dict_count += 1
+            if self.dict_count > start:
+                yield '@'
 
-        return dicts
+    def open_store(self):
+        """
+        Open the resolution store
+        :return: ResolutionStore or None if it is not usable
+        """
+        tmp_dir = self.project_directory + '/tmp'
+        try:
+            if not os.path.isdir(tmp_dir):
+                os.mkdir(tmp_dir, 0o777)
+            return ResolutionStore(self.store_path, self.domain)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f'Resolution store is not available, incremental mode is disabled. {e}')
+            return None
+
+    def iter_brute_subs(self, start=0):
+        """
+        Subdomains to brute, in incremental mode the NXDOMAIN names which are not due
+        for a reprobe are skipped and the known live names are re-checked
+        :param start: dict position to continue from
+        :return: generator of (dict position, subdomain), the position is None for names out of the dict
+        """
+        if not self.incremental or self.store is None:
+            for sub in self.load_sub_domain_dict(start):
+                yield self.dict_count, sub
+            return
+        resting = self.store.resting(self.reprobe_days)
+        live = self.store.live()
+        live.discard(self.domain)
+        skipped = 0
+        for sub in self.load_sub_domain_dict(start):
+            sub_domain = self.domain if sub == '@' else f'{sub}.{self.domain}'
+            if sub_domain in resting:
+                skipped += 1
+                # finished without a query
+                self.dict_progress.finish(self.dict_count)
+                continue
+            live.discard(sub_domain)
+            yield self.dict_count, sub
+        # live names found by CA, AXFR, RS... of the earlier runs
+        dicts_choose, dicts_count = self.shard
+        for sub_domain in live:
+            sub = sub_domain[:-len(self.domain) - 1]
+            if dicts_count == 1 or zlib.crc32(sub.encode('utf-8')) % dicts_count == dicts_choose:
+                yield None, sub
+        logger.info(f'Incremental: skip {skipped} NXDOMAIN subdomains not due for a reprobe')
+
+    def observe(self, sub_domain, ips, ttl=None):
+        """
+        Record the resolution in the store
+        :param sub_domain:
+        :param ips: None for NXDOMAIN
+        :param ttl:
+        :return:
+        """
+        if self.store is not None:
+            self.store.observe(sub_domain, ips, ttl)
+
+    def iter_total_subs(self, extra_subs):
+        """
+        Subdomains from the dict followed by the extra ones which are not in it
+        :param extra_subs:
+        :return: generator of subdomains
+        """
+        extra_subs = set(extra_subs)
+        for sub in self.load_sub_domain_dict():
+            if sub in extra_subs:
+                continue
+            yield sub
+        yield from extra_subs
+
+    def add_result(self, sub_domain, ips, phase=None):
+        """
+        Record a subdomain, worker processes stream it to the parent
+        Once it is in the sink or sent to the parent, only its name is kept, for the dedup of the frontier
+        :param sub_domain:
+        :param ips:
+        :param phase: source of the result, the current phase by default
+        :return:
+        """
+        if phase is None:
+            phase = self.rs_seen.get(sub_domain, self.phase)
+        self.data[sub_domain] = ips if self.sink is None and self.result_conn is None else None
+        if self.result_conn is not None:
+            self.result_conn.send(('data', sub_domain, ips, phase))
+            return
+        if self.sink is not None:
+            self.sink.write(sub_domain, ips, phase)
+        if ips:
+            self.harvest(sub_domain, ips[0])
+
+    def open_sink(self, append=False):
+        """
+        Open the result sink, tmp/.{domain}.jsonl
+        :param append: keep the results of the interrupted scan
+        :return: ResultSink or None if it is not usable
+        """
+        tmp_dir = self.project_directory + '/tmp'
+        try:
+            if not os.path.isdir(tmp_dir):
+                os.mkdir(tmp_dir, 0o777)
+            return ResultSink(self.sink_path, append)
+        except OSError as e:
+            logger.warning(f'Result sink is not available, results are only written at the end. {e}')
+            return None
+
+    async def persist(self):
+        """
+        Sync the result sink every fsync_interval seconds, and checkpoint every checkpoint_interval
+        :return:
+        """
+        checkpoint_time = time.monotonic()
+        while True:
+            await asyncio.sleep(self.sink.fsync_interval)
+            if time.monotonic() - checkpoint_time >= self.checkpoint_interval:
+                self.save_checkpoint()
+                checkpoint_time = time.monotonic()
+            else:
+                self.sink.sync()
+
+    def progress_state(self):
+        """
+        Progress of this process, the wildcard_subs up to it are in the result sink
+        :return:
+        """
+        return {
+            'dict_position': self.dict_progress.position,
+            'rsc_position': self.rsc_progress.position,
+        }
+
+    def restore_progress(self, progress, wildcard_subs):
+        """
+        Continue from a checkpointed progress
+        :param progress:
+        :param wildcard_subs: RSC candidates read back from the result sink
+        :return:
+        """
+        self.dict_progress = Watermark(progress['dict_position'])
+        self.rsc_progress = Watermark(progress['rsc_position'])
+        self.wildcard_subs = list(wildcard_subs)
+        self.progress_sent = len(self.wildcard_subs)
+
+    def new_wildcard_subs(self):
+        """
+        wildcard_subs found since the last call
+        :return:
+        """
+        wildcard_subs = self.wildcard_subs[self.progress_sent:]
+        self.progress_sent += len(wildcard_subs)
+        return wildcard_subs
+
+    def send_progress(self):
+        """
+        Send the progress of the worker to the parent, with the new wildcard_subs
+        :return:
+        """
+        self.result_conn.send(('progress', self.shard, self.dict_progress.position, self.rsc_progress.position,
+                               self.new_wildcard_subs()))
+
+    async def report_progress(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval / 2)
+            self.send_progress()
+
+    def save_checkpoint(self):
+        """
+        Write the checkpoint, tmp/.{domain}.checkpoint
+        The results and the RSC candidates are synced first, so the sink holds everything the checkpoint counts as done
+        :return:
+        """
+        progress = dict(self.shard_progress)
+        if self.workers <= 1:
+            self.sink.candidates(self.new_wildcard_subs(), self.shard)
+            progress[self.shard] = self.progress_state()
+        self.sink.sync()
+        # plain JSON, the checkpoint may come back from a shared cache and must not run code when loaded;
+        # the seen names are rebuilt from the sink, only the unchecked ones are written every time
+        checkpoint = {
+            'version': __version__,
+            'domain': self.domain,
+            'shard': self.shard_key(self.shard),
+            'only_similarity': self.only_similarity,
+            'wildcard': self.wildcard_state(),
+            'progress': {self.shard_key(shard): p for shard, p in progress.items()},
+            'rs_pending': {name: self.rs_seen.get(name) for name in self.rs_pending},
+        }
+        path = self.checkpoint_path + '.tmp'
+        try:
+            with open(path, 'w', encoding='utf-8') as fp:
+                json.dump(checkpoint, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(path, self.checkpoint_path)
+        except OSError as e:
+            logger.warning(f'Checkpoint is not saved. {e}')
+
+    def load_checkpoint(self):
+        """
+        Checkpoint of the interrupted scan of the domain
+        :return: checkpoint or None to start a new scan
+        """
+        if not os.path.isfile(self.checkpoint_path) or not os.path.isfile(self.sink_path):
+            logger.info(f'No checkpoint of {self.domain}, start a new scan')
+            return None
+        try:
+            with open(self.checkpoint_path, encoding='utf-8') as fp:
+                checkpoint = json.load(fp)
+            if checkpoint.get('version') != __version__ or checkpoint.get('domain') != self.domain \
+                    or checkpoint.get('shard') != self.shard_key(self.shard):
+                logger.warning(f'Checkpoint {self.checkpoint_path} is of another version or split, start a new scan')
+                return None
+            checkpoint['progress'] = {self.parse_shard_key(k): p for k, p in checkpoint['progress'].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f'Checkpoint {self.checkpoint_path} is not readable, start a new scan. {e}')
+            return None
+        return checkpoint
+
+    @staticmethod
+    def shard_key(shard):
+        """
+        Dict shard as a JSON key, i/n
+        :param shard:
+        :return:
+        """
+        return '{0}/{1}'.format(*shard)
 
-    async def query(self, sub):
+    @staticmethod
+    def parse_shard_key(key):
+        index, count = key.split('/')
+        return int(index), int(count)
+
+    def restore_checkpoint(self, checkpoint, pool=None):
+        """
+        Continue the interrupted scan, without detecting again or probing the finished names
+        :param checkpoint:
+        :param pool: shared resolver pool, built here if not given
+        :return: True if subdomains can only be enumerated by RSC
+        """
+        self.apply_wildcard_state(checkpoint['wildcard'], pool)
+        self.shard_progress = checkpoint['progress']
+        self.shard_candidates = ResultSink.read_candidates(self.sink_path)
+        if self.workers <= 1 and self.shard in self.shard_progress:
+            self.restore_progress(self.shard_progress[self.shard], self.shard_candidates[self.shard])
+        # names checked before the interruption are in the sink if they were results, the others are checked again
+        self.rs_seen = {name: source for name, source in ResultSink.read(self.sink_path, 'phase').items()
+                        if source in self.frontier_sources}
+        for name, source in checkpoint['rs_pending'].items():
+            self.rs_seen[name] = source
+            self.rs_pending.add(name)
+            self.rs_queue.put_nowait(name)
+        logger.info(f'Resume from {self.checkpoint_path}: {len(self.data)} results, '
+                    f'{len(self.rs_pending)} redirect/response domains to check')
+        return checkpoint['only_similarity']
+
+    async def query(self, sub, wildcard_subs=None):
         """
         Query domain
         :param sub:
+        :param wildcard_subs: collects the names answered by the wildcard, self.wildcard_subs by default
         :return:
         """
-        global domain_domain_ips
         ret = None
         # root domain
         if sub == '@' or sub == '':
@@ -372,9 +2013,9 @@ class EnumSubDomain(threading.Thread):
         # 如果存在特定异常则进行重试
         for i in range(4):
             try:
-                ret = await self.resolver.query(sub_domain, 'A')
+                ret = await self.cache.query(sub_domain, 'A')
             except aiodns.error.DNSError as e:
-                err_code, err_msg = e.args[0], e.args[1]
+                err_code = e.args[0]
                 # 域名确实不存在
                 # 4:  Domain name not found
                 # 1:  DNS server returned answer with no data
@@ -386,27 +2027,53 @@ class EnumSubDomain(threading.Thread):
                         logger.warning(f'Try {i + 1} times, but failed. {sub_domain} {e}')
                         self.dns_query_errors = self.dns_query_errors + 1
                     continue
-            except Exception as e:
+                self.observe(sub_domain, None)
+            except Exception:
                 logger.info(sub_domain)
                 logger.warning(traceback.format_exc())
             else:
-                ret = [r.host for r in ret]
-                domain_ips = [s for s in ret]
+                # the only list built per answer, it is the stored result
+                domain_ips = sorted(r.host for r in ret)
+                if self.store is not None:
+                    self.store.observe(sub_domain, domain_ips, min(r.ttl for r in ret) if ret else None)
+                ret = domain_ips
                 # It is a wildcard domain name and
                 # the subdomain IP that is burst is consistent with the IP
                 # that does not exist in the domain name resolution,
                 # the response similarity is discarded for further processing.
-                if self.is_wildcard_domain and (
-                        sorted(self.wildcard_ips) == sorted(domain_ips) or set(domain_ips).issubset(
-                    self.wildcard_ips)):
+                # the apex is never covered by its own wildcard
+                wildcard = subnet_only = False
+                if self.is_wildcard_domain and sub_domain != self.domain:
+                    wildcard = self.wildcard_index.issuperset(domain_ips)
+                    if not wildcard and self.in_wildcard_subnets(domain_ips):
+                        wildcard = await self.confirm_wildcard_ips(domain_ips)
+                        subnet_only = not wildcard
+                zone_wildcard = False
+                if not wildcard and sub_domain.count('.') > self.domain.count('.') + 1:
+                    # home.dev.example.com may be answered by *.dev.example.com
+                    zone = sub_domain[sub_domain.index('.') + 1:]
+                    zone_wildcard = (await self.zone_wildcard(zone)).issuperset(domain_ips)
+                if zone_wildcard:
+                    # RSC compares with the pages of the apex wildcard, it has no baseline for the zone
+                    logger.debug('%s answered by the wildcard of %s, drop it', sub_domain, zone)
+                elif self.skip_rsc and subnet_only:
+                    # a real host next to the wildcard pool as likely as an IP of the pool the probes missed
+                    self.subnet_suspects += 1
+                    self.add_result(sub_domain, domain_ips, 'wildcard-subnet')
+                    self.count += 1
+                    logger.info(f'{self.remainder} {len(self.data)} {sub_domain} {domain_ips} (in the wildcard subnets)')
+                    domain_domain_ips.append((sub_domain, domain_ips))
+                elif wildcard or subnet_only:
+                    # lazy formatting, wildcard answers are the bulk of a wildcard domain
                     if self.skip_rsc:
-                        logger.debug(
-                            f'{sub_domain} maybe wildcard subdomain, but it is --skip-rsc mode now, it will be drop this subdomain in results')
+                        logger.debug('%s maybe wildcard subdomain, but it is --skip-rsc mode now, '
+                                     'it will be drop this subdomain in results', sub_domain)
                     else:
-                        logger.debug(f'{self.remainder} maybe wildcard domain, continue RSC {sub_domain}')
+                        logger.debug('%s maybe wildcard domain, continue RSC %s', self.remainder, sub_domain)
+                        (self.wildcard_subs if wildcard_subs is None else wildcard_subs).append(sub_domain)
                 else:
                     if sub != self.wildcard_sub:
-                        self.data[sub_domain] = sorted(domain_ips)
+                        self.add_result(sub_domain, domain_ips)
                         print('', end='\n')
                         self.count += 1
                         logger.info(f'{self.remainder} {len(self.data)} {sub_domain} {domain_ips}')
@@ -415,62 +2082,247 @@ class EnumSubDomain(threading.Thread):
         self.remainder += -1
         return sub_domain, ret
 
-    @staticmethod
-    def limited_concurrency_coroutines(coros, limit):
-        futures = [
-            asyncio.ensure_future(c)
-            for c in islice(coros, 0, limit)
-        ]
+    def discover(self, name, sub_domain, source, verbose=True):
+        """
+        Queue a name found in a redirect or a response, once
+        :param name:
+        :param sub_domain: response the name was found in
+        :param source: redirect, response, certificate or axfr
+        :param verbose: log the name, zone transfers are too many
+        :return:
+        """
+        if name in self.rs_seen:
+            return
+        self.rs_seen[name] = source
+        if self.result_conn is not None:
+            # the parent owns the frontier
+            self.result_conn.send(('rs', name, sub_domain, source))
+            return
+        if verbose:
+            print('', end='\n')
+            logger.info(f'[{sub_domain}] add {source} domain: {name}({self.rs_queue.qsize()})')
+        self.rs_pending.add(name)
+        self.rs_queue.put_nowait(name)
 
-        async def first_to_finish():
-            while True:
-                await asyncio.sleep(0)
-                for f in futures:
-                    if f.done():
-                        futures.remove(f)
-                        try:
-                            nf = next(coros)
-                            futures.append(asyncio.ensure_future(nf))
-                        except StopIteration:
-                            pass
-                        return f.result()
-
-        while len(futures) > 0:
-            yield first_to_finish()
-
-    async def start_e(self, tasks, tasks_num):
+    def start_frontier(self):
+        """
+        Check the discovered names as they come, next to the brute force and RSC
+        :return:
+        """
+        self.rs_queue = asyncio.Queue()
+        self.rs_tasks = [asyncio.ensure_future(self.rs_worker()) for _ in range(self.coroutine_count_rs)]
+
+    async def rs_worker(self):
+        while True:
+            sub_domain = await self.rs_queue.get()
+            try:
+                await self.check_discovered(sub_domain)
+            except Exception:
+                logger.debug(traceback.format_exc())
+            finally:
+                self.rs_pending.discard(sub_domain)
+                self.rs_queue.task_done()
+
+    async def check_discovered(self, sub_domain):
+        """
+        DNS first, a name answered by other IPs is a result already, only wildcard answers need HTTP
+        :param sub_domain:
+        :return:
+        """
+        self.rs_count += 1
+        if sub_domain in self.data:
+            return
+        sub = ''.join(sub_domain.rsplit(self.domain, 1)).rstrip('.')
+        wildcard_subs = []
+        await self.query(sub, wildcard_subs)
+        if wildcard_subs:
+            await self.similarity(sub)
+
+    def harvest(self, sub_domain, ip=None):
+        """
+        Read the certificate of a live host in the background
+        :param sub_domain:
+        :param ip: resolved first if not given
+        :return:
+        """
+        if self.ca is None:
+            return
+        task = asyncio.ensure_future(self.harvest_host(sub_domain, ip))
+        self.cert_tasks.add(task)
+        task.add_done_callback(self.cert_tasks.discard)
+
+    async def harvest_host(self, sub_domain, ip=None):
+        if ip is None:
+            try:
+                ip = (await self.cache.query(sub_domain, 'A'))[0].host
+            except aiodns.error.DNSError:
+                return
+        for name in await self.ca.get_subdomains(sub_domain, ip):
+            if name != sub_domain:
+                self.discover(name, sub_domain, 'certificate')
+
+    async def drain_frontier(self):
+        """
+        Wait until the names discovered from the discovered names are checked too
+        Certificates and the frontier feed each other, both are drained
+        :return:
+        """
+        if self.rs_queue is None:
+            return
+        if self.rs_queue.qsize():
+            logger.info(f'RS(redirect/response) domains({self.rs_queue.qsize()}) left...')
+        while True:
+            await self.rs_queue.join()
+            if not self.cert_tasks:
+                break
+            await asyncio.wait(list(self.cert_tasks))
+        for task in self.rs_tasks:
+            task.cancel()
+        await asyncio.gather(*self.rs_tasks, return_exceptions=True)
+        self.rs_tasks = []
+        self.rs_queue = None
+        logger.info(f'RS(redirect/response) domain count: {self.rs_count}')
+        if self.ca is not None:
+            logger.info(f'CA handshakes: {self.ca.handshakes} certificates: {len(self.ca.fingerprints)}')
+            self.ca = None
+
+    async def start_e(self, tasks, tasks_num, limit=None):
         """
         Limit the number of coroutines for reduce memory footprint
         :param tasks:
+        :param tasks_num:
+        :param limit: coroutines in flight, coroutine_count_dns by default
         :return:
         """
-        for res in tqdm(self.limited_concurrency_coroutines(tasks, self.coroutine_count),
-                        bar_format="%s{l_bar}%s{bar}%s{r_bar}%s" % (Fore.YELLOW, Fore.YELLOW, Fore.YELLOW, Fore.RESET),
-                        total=tasks_num):
-            await res
+        with tqdm(bar_format="%s{l_bar}%s{bar}%s{r_bar}%s" % (Fore.YELLOW, Fore.YELLOW, Fore.YELLOW, Fore.RESET),
+                  total=tasks_num, disable=not self.progress) as progress:
+            status = asyncio.ensure_future(self.show_status(progress))
+            try:
+                await self.scheduler(self.coroutine_count_dns if limit is None else limit).run(tasks, progress)
+            finally:
+                status.cancel()
 
-    @staticmethod
-    def data_clean(data):
+    def scheduler(self, limit):
+        """
+        Scheduler of the in-flight budget
+        :param limit:
+        :return:
+        """
+        if limit not in self.schedulers:
+            self.schedulers[limit] = FairScheduler(limit)
+        return self.schedulers[limit]
+
+    async def show_status(self, progress):
+        """
+        Show the live resolver pool status next to the progress bar
+        :param progress:
+        :return:
+        """
+        while True:
+            if isinstance(self.resolver, ResolverPool):
+                progress.set_postfix_str(self.resolver.summary(), refresh=False)
+            await asyncio.sleep(1)
+
+    def http_session(self):
+        """
+        HTTP session of the scan, created on first use
+        Connections are kept alive and pooled per IP, so the candidates of a wildcard share them
+        :return:
+        """
+        if self.session is None:
+            resolver = CachedResolver(self.cache) if self.cache is not None else AsyncResolver(
+                nameservers=self.dns_servers)
+            # certificates are not verified, as with verify=False of the wildcard page requests:
+            # RSC compares the pages, wildcard and parked hosts often serve invalid certificates
+            conn = aiohttp.TCPConnector(resolver=resolver, limit=self.coroutine_count_request,
+                                        limit_per_host=self.http_limit_per_host, keepalive_timeout=30, ssl=False)
+            # cookies of one candidate must not leak into the others sharing its IP
+            self.session = aiohttp.ClientSession(connector=conn, headers=self.request_headers,
+                                                 cookie_jar=aiohttp.DummyCookieJar())
+        return self.session
+
+    async def close_http_session(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def http_target(self, url):
+        """
+        Request the already resolved IP with a Host header instead of the name
+        :param url:
+        :return: url, headers
+        """
+        parts = urllib.parse.urlsplit(url)
+        # TLS needs the name for SNI
+        if parts.scheme != 'http' or not parts.hostname or self.cache is None:
+            return url, None
         try:
-            html = re.sub(r'\s', '', data)
-            html = re.sub(r'<script(?!.*?src=).*?>.*?</script>', '', html)
-            return html
-        except BaseException:
-            return data
+            records = await self.cache.query(parts.hostname, 'A')
+        except aiodns.error.DNSError:
+            return url, None
+        netloc = records[0].host if parts.port is None else f'{records[0].host}:{parts.port}'
+        return urllib.parse.urlunsplit(parts._replace(netloc=netloc)), {'Host': parts.netloc}
 
     @staticmethod
+    def decode_body(body, content_type):
+        """
+        Decode a body with the charset of its Content-Type, the same way for the candidates and the baseline
+        :param body:
+        :param content_type:
+        :return:
+        """
+        charset = re.search(r'charset=["\']?([\w-]+)', content_type or '', re.I)
+        # the byte cap may cut the last character, it is replaced instead of decoding all of the page another way
+        try:
+            return body.decode(charset.group(1) if charset else 'utf-8', errors='replace')
+        except LookupError:
+            return body.decode('utf-8', errors='replace')
+
+    async def read_body(self, response, baseline=None):
+        """
+        Read at most http_max_body bytes of the body in chunks
+        :param response:
+        :param baseline: (fingerprint, html) of the wildcard response
+        :return: html, or the baseline html if the response is the wildcard one
+        """
+        chunks = []
+        size = 0
+        async for chunk in response.content.iter_chunked(self.http_chunk_size):
+            chunks.append(chunk)
+            size += len(chunk)
+            if baseline is not None and size >= self.http_prefix_size:
+                (length, prefix), html = baseline
+                # same length and same head as the wildcard page, the rest is not worth downloading
+                if length is not None and response.content_length == length and \
+                        b''.join(chunks).startswith(prefix):
+                    return html
+                baseline = None
+            if size >= self.http_max_body:
+                break
+        return self.decode_body(b''.join(chunks)[:self.http_max_body], response.headers.get('Content-Type'))
+
     @backoff.on_exception(backoff.expo, TimeoutError, max_tries=3)
-    async def fetch(session, url):
+    async def fetch(self, session, url, baseline=None):
         """
         Fetch url response with session
+        Redirects are followed here, every hop picks its own IP and Host header
         :param session:
         :param url:
-        :return:
+        :param baseline: (fingerprint, html) of the wildcard response
+        :return: html, redirect responses
         """
+        history = []
         try:
             async with async_timeout.timeout(20):
-                async with session.get(url) as response:
-                    return await response.text(), response.history
+                for i in range(self.http_max_redirects + 1):
+                    target, headers = await self.http_target(url)
+                    async with session.get(target, headers=headers, allow_redirects=False) as response:
+                        location = response.headers.get('location')
+                        if response.status not in (301, 302, 303, 307, 308) or not location:
+                            return await self.read_body(response, baseline), history
+                        history.append(response)
+                        url = urllib.parse.urljoin(url, location)
+                raise aiohttp.TooManyRedirects(response.request_info, tuple(history))
         except Exception as e:
             # TODO 当在随机DNS场景中只做响应相似度比对的话，如果域名没有Web服务会导致相似度比对失败从而丢弃
             logger.warning(f'fetch exception: {type(e).__name__} {url}')
@@ -489,8 +2341,6 @@ class EnumSubDomain(threading.Thread):
             sub = ''.join(sub.rsplit(self.domain, 1)).rstrip('.')
             sub_domain = f'{sub}.{self.domain}'
 
-        if sub_domain in self.domains_rs:
-            self.domains_rs.remove(sub_domain)
         full_domain = f'http://{sub_domain}'
         # 如果跳转中的域名是以下情况则不加入下一轮RSC
         skip_domain_with_history = [
@@ -501,110 +2351,179 @@ class EnumSubDomain(threading.Thread):
             '{domain}'.format(domain=sub_domain),
         ]
         try:
-            regex_domain = r"((?!\/)(?:(?:[a-z\d-]*\.)+{d}))".format(d=self.domain)
-            resolver = AsyncResolver(nameservers=self.dns_servers)
-            conn = aiohttp.TCPConnector(resolver=resolver)
-            async with aiohttp.ClientSession(connector=conn, headers=self.request_headers) as session:
-                html, history = await self.fetch(session, full_domain)
-                html = self.data_clean(html)
-                if history is not None and len(history) > 0:
-                    location = str(history[-1].headers['location'])
-                    if '.' in location:
-                        location_split = location.split('/')
-                        if len(location_split) > 2:
-                            location = location_split[2]
-                        else:
-                            location = location
-                        try:
-                            location = re.match(regex_domain, location).group(0)
-                        except AttributeError:
-                            location = location
-                        status = history[-1].status
-                        if location in skip_domain_with_history and len(history) >= 2:
-                            logger.debug(f'domain in skip: {sub_domain} {status} {location}')
-                            return
-                        else:
-                            # cnsuning.com suning.com
-                            if location[-len(self.domain) - 1:] == '.{d}'.format(d=self.domain):
-                                # collect redirecting's domains
-                                if sub_domain != location and location not in self.domains_rs and location not in self.domains_rs_processed:
-                                    print('', end='\n')
-                                    logger.info(
-                                        f'[{sub_domain}] add redirect domain: {location}({len(self.domains_rs)})')
-                                    self.domains_rs.append(location)
-                                    self.domains_rs_processed.append(location)
-                            else:
-                                print('', end='\n')
-                                logger.info(f'not same domain: {location}')
+            session = self.http_session()
+            if sub.count('.') == 0:
+                baseline = self.wildcard_fingerprint, self.wildcard_html
+            else:
+                baseline = self.wildcard_fingerprint3, self.wildcard_html3
+            if baseline[0] is None:
+                baseline = None
+            html, history = await self.fetch(session, full_domain, baseline)
+            if history is not None and len(history) > 0:
+                location = str(history[-1].headers['location'])
+                if '.' in location:
+                    location_split = location.split('/')
+                    if len(location_split) > 2:
+                        location = location_split[2]
                     else:
-                        print('', end='\n')
-                        logger.info(f'not domain(maybe path): {location}')
-                if html is None:
-                    print('', end='\n')
-                    logger.warning(f'domain\'s html is none: {sub_domain}')
-                    return
-                # collect response html's domains
-                response_domains = re.findall(regex_domain, html)
-                response_domains = list(set(response_domains) - {sub_domain})
-                for rd in response_domains:
-                    rd = rd.strip().strip('.')
-                    if rd.count('.') >= sub_domain.count('.') and rd[-len(sub_domain):] == sub_domain:
-                        continue
-                    if rd not in self.domains_rs:
-                        if rd not in self.domains_rs_processed:
+                        location = location
+                    location = self.response_analyzer.match_host(location) or location
+                    status = history[-1].status
+                    if location in skip_domain_with_history and len(history) >= 2:
+                        logger.debug(f'domain in skip: {sub_domain} {status} {location}')
+                        return
+                    else:
+                        # cnsuning.com suning.com
+                        if location[-len(self.domain) - 1:] == '.{d}'.format(d=self.domain):
+                            # collect redirecting's domains
+                            if sub_domain != location:
+                                self.discover(location, sub_domain, 'redirect')
+                        else:
                             print('', end='\n')
-                            logger.info(f'[{sub_domain}] add response domain: {rd}({len(self.domains_rs)})')
-                            self.domains_rs.append(rd)
-                            self.domains_rs_processed.append(rd)
-
-                if len(html) == self.wildcard_html_len:
-                    ratio = 1
-                else:
-                    # SPEED 4 2 1, but here is still the bottleneck
-                    # real_quick_ratio() > quick_ratio() > ratio()
-                    # TODO bottleneck
-                    if sub.count('.') == 0:  # secondary sub, ex: www
-                        ratio = SequenceMatcher(None, html, self.wildcard_html).real_quick_ratio()
-                        ratio = round(ratio, 3)
-                    else:  # tertiary sub, ex: home.dev
-                        ratio = SequenceMatcher(None, html, self.wildcard_html3).real_quick_ratio()
-                        ratio = round(ratio, 3)
-                self.remainder += -1
-                if ratio > self.rsc_ratio:
-                    # passed
-                    logger.debug(f'{self.remainder} RSC ratio: {ratio} (passed) {sub_domain}')
+                            logger.info(f'not same domain: {location}')
                 else:
-                    # added
-                    # for def distinct func
-                    # self.wildcard_domains[sub_domain] = html
-                    if self.response_filter is not None:
-                        for resp_filter in self.response_filter.split(','):
-                            if resp_filter in html:
-                                logger.debug(f'{self.remainder} RSC filter in response (passed) {sub_domain}')
-                                return
-                            else:
-                                continue
-                        self.data[sub_domain] = self.wildcard_ips
-                    else:
-                        self.data[sub_domain] = self.wildcard_ips
                     print('', end='\n')
-                    logger.info(f'{self.remainder} RSC ratio: {ratio} (added) {sub_domain}')
-        except Exception as e:
+                    logger.info(f'not domain(maybe path): {location}')
+            if html is None:
+                print('', end='\n')
+                logger.warning(f'domain\'s html is none: {sub_domain}')
+                return
+            ratio, fingerprint, response_domains, filtered = await self.analyze(html, sub.count('.') != 0)
+            # collect response html's domains
+            for rd in response_domains:
+                if rd == sub_domain:
+                    continue
+                if rd.count('.') >= sub_domain.count('.') and rd[-len(sub_domain):] == sub_domain:
+                    continue
+                self.discover(rd, sub_domain, 'response')
+            if (self.wildcard_html if sub.count('.') == 0 else self.wildcard_html3) is None:
+                # the wildcard page could not be fetched, there is nothing to compare with
+                logger.debug(f'no wildcard response to compare with (passed) {sub_domain}')
+                return
+
+            self.remainder += -1
+            if ratio > self.rsc_ratio:
+                # passed
+                logger.debug(f'{self.remainder} RSC ratio: {ratio} (passed) {sub_domain}')
+            else:
+                # added
+                if filtered:
+                    logger.debug(f'{self.remainder} RSC filter in response (passed) {sub_domain}')
+                    return
+                self.add_result(sub_domain, self.wildcard_ips)
+                # for def distinct func
+                self.wildcard_domains[sub_domain] = fingerprint
+                if self.result_conn is not None:
+                    self.result_conn.send(('rsc', sub_domain, fingerprint))
+                print('', end='\n')
+                logger.info(f'{self.remainder} RSC ratio: {ratio} (added) {sub_domain}')
+        except Exception:
             logger.debug(traceback.format_exc())
             return
 
+    def analysis_executor(self):
+        """
+        Pool analysing the responses, created on first use
+        :return:
+        """
+        if self.analysis_pool is None:
+            if multiprocessing.current_process().daemon:
+                # worker processes can not have children
+                self.analysis_pool = concurrent.futures.ThreadPoolExecutor(self.analysis_workers,
+                                                                           thread_name_prefix='esd-analysis')
+            else:
+                self.analysis_pool = concurrent.futures.ProcessPoolExecutor(
+                    self.analysis_workers, mp_context=multiprocessing.get_context('spawn'))
+            self.analysis_pool_owner = True
+        return self.analysis_pool
+
+    def close_analysis_executor(self):
+        if self.analysis_pool is not None and self.analysis_pool_owner:
+            self.analysis_pool.shutdown()
+        self.analysis_pool = None
+
+    async def run_analysis(self, html, tertiary):
+        args = (html, self.wildcard_html_len, self.wildcard_fingerprints()[tertiary])
+        if self.analysis_workers == 0:
+            return self.response_analyzer(*args)
+        if self.analysis_slots is None:
+            self.analysis_slots = asyncio.Semaphore(2 * self.analysis_workers)
+        # fetches wait here while the pool is busy, instead of piling up bodies in its queue
+        async with self.analysis_slots:
+            return await self.loop.run_in_executor(self.analysis_executor(), self.response_analyzer, *args)
+
+    async def analyze(self, html, tertiary):
+        """
+        Analyze a response in the analysis pool, once per distinct body
+        Parked pages and SPA shells repeat a lot, concurrent copies share one analysis
+        :param html:
+        :param tertiary: compare with wildcard_html3 instead of wildcard_html
+        :return: ratio, fingerprint, hostnames in the response, whether the response filter matched
+        """
+        key = (hashlib.blake2b(html.encode('utf-8'), digest_size=16).digest(), tertiary)
+        analysis = self.response_cache.get(key)
+        if analysis is not None:
+            self.response_cache.move_to_end(key)
+            self.response_cache_hits += 1
+        else:
+            self.response_cache_misses += 1
+            analysis = self.response_cache[key] = asyncio.ensure_future(self.run_analysis(html, tertiary))
+
+            def forget_failure(f):
+                if f.cancelled() or f.exception() is not None:
+                    self.response_cache.pop(key, None)
+
+            analysis.add_done_callback(forget_failure)
+            if len(self.response_cache) > self.response_cache_size:
+                self.response_cache.popitem(last=False)
+        return await asyncio.shield(analysis)
+
+    def wildcard_fingerprints(self):
+        """
+        Fingerprints of wildcard_html and wildcard_html3
+        :return:
+        """
+        if self.wildcard_html_fps is None:
+            self.wildcard_html_fps = (self.similarity_engine.fingerprint(self.wildcard_html or ''),
+                                      self.similarity_engine.fingerprint(self.wildcard_html3 or ''))
+        return self.wildcard_html_fps
+
     def distinct(self):
-        for domain, html in self.wildcard_domains.items():
-            for domain2, html2 in self.wildcard_domains.items():
-                ratio = SequenceMatcher(None, html, html2).real_quick_ratio()
-                if ratio > self.rsc_ratio:
-                    # remove this domain
-                    if domain2 in self.data:
-                        del self.data[domain2]
-                    m = 'Remove'
-                else:
-                    m = 'Stay'
-                logger.info(f'{domain} : {domain2} {ratio} {m}')
+        """
+        Drop the RSC results which are near duplicates of an earlier one
+        Results are bucketed by the LSH bands of their fingerprints, only results sharing a bucket are compared
+        :return:
+        """
+        engine = self.similarity_engine
+        buckets = {}
+        for domain, fingerprint in self.wildcard_domains.items():
+            duplicate = None
+            for band in engine.bands(fingerprint):
+                for domain2, fingerprint2 in buckets.get(band, ()):
+                    if engine.ratio(fingerprint, fingerprint2) > self.rsc_ratio:
+                        duplicate = domain2
+                        break
+                if duplicate is not None:
+                    break
+            if duplicate is not None:
+                # remove this domain
+                self.data.pop(domain, None)
+                if self.sink is not None:
+                    self.sink.remove(domain)
+                logger.info(f'{domain} : {duplicate} Remove')
+            else:
+                for band in engine.bands(fingerprint):
+                    buckets.setdefault(band, []).append((domain, fingerprint))
+
+    def new_resolver(self, nameservers):
+        """
+        Create a resolver with the selected engine
+        :param nameservers:
+        :return:
+        """
+        if self.engine == 'udp':
+            return UDPResolver(nameservers[0], loop=self.loop, timeout=self.resolve_timeout)
+        return aiodns.DNSResolver(loop=self.loop, nameservers=nameservers, timeout=self.resolve_timeout)
 
     def check(self, dns):
         logger.info(f"Checking if DNS server {dns} is available")
@@ -622,62 +2541,124 @@ class EnumSubDomain(threading.Thread):
             try:
                 sock.recv(4096)
                 break
-            except socket.timeout as e:
+            except socket.timeout:
                 logger.warning('check dns server timeout Failed!')
             if i == 2:
                 return False
         return True
 
-    def run(self):
+    def check_dns_servers(self):
         """
-        Run
+        DNS servers which are available
         :return:
         """
-        global task_flag
-        logger.info(f'Version: {__version__}')
-        logger.info('----------')
-        logger.info(f'Start domain: {self.domain}')
-        start_time = time.time()
-        subs = self.load_sub_domain_dict()
-        logger.info(f'Sub domain dict count: {len(subs)}')
-        logger.info('Generate coroutines...')
-        # Verify that all DNS server results are consistent
-        stable_dns = []
-        wildcard_ips = None
-        last_dns = []
-        only_similarity = False
-        for dns in self.dns_servers:
-            delay = self.check(dns)
+        servers = []
+        for server in self.dns_servers:
+            delay = self.check(server)
             if not delay:
-                logger.warning(f"@{dns} is not available, skip this DNS server")
+                logger.warning(f"@{server} is not available, skip this DNS server")
                 continue
-            self.resolver = aiodns.DNSResolver(loop=self.loop, nameservers=[dns], timeout=self.resolve_timeout)
-            job = self.query(self.wildcard_sub)
-            sub, ret = self.loop.run_until_complete(job)
-            logger.info(f'@{dns} {sub} {ret}')
-            if ret is None:
-                ret = None
-            else:
-                ret = sorted(ret)
+            servers.append(server)
+        return servers
 
-            if dns in self.stable_dns_servers:
-                wildcard_ips = ret
-            stable_dns.append(ret)
+    @staticmethod
+    async def lookup(resolver, sub_domain):
+        """
+        Resolve a name, retrying like query()
+        :param resolver:
+        :param sub_domain:
+        :return: sorted IPs or None
+        """
+        ret = None
+        for i in range(4):
+            try:
+                ret = sorted(r.host for r in await resolver.query(sub_domain, 'A'))
+            except aiodns.error.DNSError as e:
+                if e.args[0] not in [1, 4]:
+                    continue
+            except Exception:
+                logger.warning(traceback.format_exc())
+            break
+        return ret
 
-            if ret:
-                equal = [False for r in ret if r not in last_dns]
-                if len(last_dns) != 0 and False in equal:
-                    only_similarity = self.is_wildcard_domain = True
-                    logger.info('Is a random resolve subdomain.')
-                    break
-                else:
-                    last_dns = ret
+    async def probe(self, server):
+        """
+        Resolve the nonexistent wildcard_sub on one DNS server
+        :param server:
+        :return: sorted IPs or None
+        """
+        sub_domain = f'{self.wildcard_sub}.{self.domain}'
+        resolver = self.new_resolver([server])
+        try:
+            ret = await self.lookup(resolver, sub_domain)
+        finally:
+            if isinstance(resolver, UDPResolver):
+                # the socket stays open until closed, aiodns frees its channel with the resolver
+                resolver.close()
+        logger.info(f'@{server} {sub_domain} {ret}')
+        return ret
+
+    async def profile_wildcard(self, seed_ips):
+        """
+        Learn the wildcard IP pool and its subnets with a burst of random labels
+        CDN backed wildcards rotate through a pool of IPs, one probe only sees a part of it
+        :param seed_ips: answers of the DNS server probes
+        :return: False if the second half of the burst still found new subnets, the pool is not trustworthy then
+        """
+        labels = [f'feei-esd-{random.getrandbits(32):08x}' for _ in range(self.wildcard_probes)]
+        answers = await asyncio.gather(*(self.lookup(self.resolver, f'{label}.{self.domain}') for label in labels))
+        ips = set(seed_ips)
+        subnets = {self.ip_subnet(ip) for ip in ips}
+        late = 0
+        for i, ret in enumerate(answers):
+            new = {self.ip_subnet(ip) for ip in ret or ()} - subnets
+            if new and i >= len(answers) // 2:
+                late += 1
+            subnets |= new
+            ips.update(ret or ())
+        self.wildcard_ips = sorted(ips)
+        self.index_wildcard_ips()
+        logger.info(f'Wildcard profile: {len(answers)} probes, {len(ips)} IPs in {len(subnets)} /24 subnets')
+        return late == 0
+
+    async def detect_wildcard(self, servers=None, pool=None):
+        """
+        Probe the DNS servers, set up the resolver pool and detect wildcard resolving
+        :param servers: available DNS servers, checked here if not given
+        :param pool: shared resolver pool, built here if not given
+        :return: True if subdomains can only be enumerated by RSC
+        """
+        # Verify that all DNS server results are consistent
+        if servers is None:
+            servers = self.check_dns_servers()
+        probes = dict(zip(servers, await asyncio.gather(*(self.probe(server) for server in servers))))
+
+        # A wildcard is answered by every honest server and a nonexistent name by none,
+        # the minority is hijacking or broken
+        answered = [server for server, ret in probes.items() if ret is not None]
+        if len(answered) * 2 < len(probes):
+            bad_dns = answered
+        elif len(answered) * 2 > len(probes):
+            bad_dns = [server for server in probes if server not in answered]
+        else:
+            bad_dns = []
+        for server in bad_dns:
+            logger.warning(f'@{server} disagrees with the other DNS servers on {self.wildcard_sub}, skip this DNS server')
+            if pool is not None:
+                pool.quarantine(server, f'disagrees on {self.wildcard_sub}.{self.domain}')
+        healthy_dns = [server for server in probes if server not in bad_dns]
+        if len(healthy_dns) == 0:
+            logger.info('No DNS server passed the checks, use the default dns server')
+            healthy_dns = self.stable_dns_servers
+        stable_dns = [probes.get(server) for server in healthy_dns]
 
-        is_all_stable_dns = stable_dns.count(stable_dns[0]) == len(stable_dns)
-        if not is_all_stable_dns:
-            logger.info('Is all stable dns: NO, use the default dns server')
-            self.resolver = aiodns.DNSResolver(loop=self.loop, nameservers=self.stable_dns_servers,
-                                               timeout=self.resolve_timeout)
+        only_similarity = False
+        if pool is None:
+            logger.info(f'Use DNS servers: {healthy_dns}')
+            pool = ResolverPool(healthy_dns, self.new_resolver, self.loop, max_window=self.coroutine_count_dns,
+                                timeout=self.resolve_timeout)
+        self.resolver = pool
+        self.cache = DNSCache(pool, self.loop)
         # Wildcard domain
         is_wildcard_domain = not (stable_dns.count(None) == len(stable_dns))
         if is_wildcard_domain or self.is_wildcard_domain:
@@ -687,118 +2668,340 @@ class EnumSubDomain(threading.Thread):
                 logger.info(
                     'This is a wildcard domain, but it is --skip-rsc mode now, it will be drop all random resolve subdomains in results')
             self.is_wildcard_domain = True
-            if wildcard_ips is not None:
-                self.wildcard_ips = wildcard_ips
-            else:
-                self.wildcard_ips = stable_dns[0]
+            if not await self.profile_wildcard(ip for ret in stable_dns for ip in ret or ()):
+                # answers can not be told apart from the wildcard by DNS
+                only_similarity = True
+                logger.info('Is a random resolve subdomain.')
             logger.info(f'Wildcard IPS: {self.wildcard_ips}')
             if not self.skip_rsc:
-                try:
-                    self.wildcard_html = requests.get(
-                        f'http://{self.wildcard_sub}.{self.domain}',
-                        headers=self.request_headers, timeout=10, verify=False).text
-                    self.wildcard_html = self.data_clean(self.wildcard_html)
-                    self.wildcard_html_len = len(self.wildcard_html)
-                    self.wildcard_html3 = requests.get(
-                        f'http://{self.wildcard_sub3}.{self.domain}',
-                        headers=self.request_headers, timeout=10, verify=False).text
-                    self.wildcard_html3 = self.data_clean(self.wildcard_html3)
-                    self.wildcard_html3_len = len(self.wildcard_html3)
-                    logger.info(
-                        f'Wildcard domain response html length: {self.wildcard_html_len} 3length: {self.wildcard_html3_len}')
-                except requests.exceptions.SSLError:
-                    logger.warning('SSL Certificate Error!')
-                except requests.exceptions.ConnectTimeout:
-                    logger.warning('Request response content failed, check network please!')
-                except requests.exceptions.ReadTimeout:
-                    self.wildcard_html = self.wildcard_html3 = ''
-                    self.wildcard_html_len = self.wildcard_html3_len = 0
-                    logger.warning(
-                        f'Request response content timeout, {self.wildcard_sub}.{self.domain} and {self.wildcard_sub3}.{self.domain} maybe not a http service, content will be set to blank!')
-                except requests.exceptions.ConnectionError:
-                    logger.error('ESD can\'t get the response text so the rsc will be skipped. ')
-                    self.skip_rsc = True
+                await self.loop.run_in_executor(None, self.fetch_wildcard_html)
         else:
             logger.info('Not a wildcard domain')
+            # random labels must not resolve, servers answering them are hijacking
+            if self.resolver.canary_domain is None:
+                self.resolver.canary_domain = self.domain
+        return only_similarity
 
-        if not only_similarity:
-            self.coroutine_count = self.coroutine_count_dns
-            tasks = (self.query(sub) for sub in subs)
-            self.loop.run_until_complete(self.start_e(tasks, len(subs)))
-            logger.info(f"Brute Force subdomain count: {self.count}")
-        dns_time = time.time()
-        time_consume_dns = int(dns_time - start_time)
-        logger.info(f'DNS query errors: {self.dns_query_errors}')
+    async def zone_wildcard(self, zone):
+        """
+        Wildcard IPs of a parent zone below the apex
+        The zone is probed the first time a name under it resolves, concurrent callers share the probe
+        :param zone:
+        :return: frozenset of IPs, empty if the zone is not a wildcard
+        """
+        task = self.zone_wildcards.get(zone)
+        if task is None:
+            task = self.zone_wildcards[zone] = asyncio.ensure_future(self.probe_zone(zone))
+        return await asyncio.shield(task)
+
+    async def probe_zone(self, zone):
+        label = f'feei-esd-{random.getrandbits(32):08x}'
+        ips = frozenset(await self.lookup(self.resolver, f'{label}.{zone}') or ())
+        if ips:
+            logger.info(f'Wildcard zone: {zone} {sorted(ips)}')
+        return ips
 
-        # CA subdomain info
-        ca_subdomains = []
-        logger.info('Collect subdomains in CA...')
-        ca_subdomains = CAInfo(self.domain).get_subdomains()
-        if len(ca_subdomains):
-            tasks = (self.query(sub) for sub in ca_subdomains)
-            self.loop.run_until_complete(self.start_e(tasks, len(ca_subdomains)))
-        logger.info(f'CA subdomain count: {len(ca_subdomains)}')
-
-        # DNS Transfer Vulnerability
-        transfer_info = []
-        logger.info(f'Check DNS Transfer Vulnerability in {self.domain}')
-        transfer_info = DNSTransfer(self.domain).transfer_info()
-        if len(transfer_info):
-            logger.warning(f'DNS Transfer Vulnerability found in {self.domain}!')
-            tasks = (self.query(sub) for sub in transfer_info)
-            self.loop.run_until_complete(self.start_e(tasks, len(transfer_info)))
-        logger.info(f'DNS Transfer subdomain count: {len(transfer_info)}')
+    @staticmethod
+    def ip_subnet(ip):
+        """
+        /24 subnet of an IPv4 address as a packed int
+        :param ip:
+        :return:
+        """
+        return struct.unpack('!I', socket.inet_aton(ip))[0] >> 8
 
-        total_subs = set(subs + transfer_info + ca_subdomains)
+    def index_wildcard_ips(self):
+        """
+        Build the wildcard index once after detection
+        Both engines answer dotted strings which cache their hash, so a membership
+        check is a hash lookup without converting or allocating anything
+        :return:
+        """
+        self.wildcard_index = frozenset(self.wildcard_ips or ())
+        self.wildcard_subnets = frozenset(self.ip_subnet(ip) for ip in self.wildcard_index)
 
-        # Use TXT,SOA,MX,AAAA record to find sub domains
-        if self.multiresolve:
-            logger.info('Enumerating subdomains with TXT, SOA, MX, AAAA record...')
-            dnsquery = DNSQuery(self.domain, total_subs, self.domain)
-            record_info = dnsquery.dns_query()
-            tasks = (self.query(record[:record.find('.')]) for record in record_info)
-            self.loop.run_until_complete(self.start_e(tasks, len(record_info)))
-            logger.info(f'DNS record subdomain count: {len(record_info)}')
+    def in_wildcard_subnets(self, ips):
+        """
+        Answers inside the wildcard subnets may be IPs of the wildcard pool the probes missed,
+        or real hosts next to it, so they do not join the index, which only holds probed IPs
+        Only called for answers which missed the index
+        :param ips:
+        :return: True if every IP is in a wildcard subnet
+        """
+        if not ips or not self.wildcard_subnets:
+            return False
+        for ip in ips:
+            if self.ip_subnet(ip) not in self.wildcard_subnets:
+                return False
+        return True
 
-        if self.is_wildcard_domain and not self.skip_rsc:
-            # Response similarity comparison
-            total_subs = set(subs + transfer_info + ca_subdomains)
-            self.wildcard_subs = list(set(subs).union(total_subs))
-            logger.info(
-                f'Enumerates {len(self.data)} sub domains by DNS mode in {str(datetime.timedelta(seconds=time_consume_dns))}')
+    async def confirm_wildcard_ips(self, ips):
+        """
+        Probe random labels again for an answer which is only in the wildcard subnets
+        The IPs answered by the probes join the index, so the rest of the pool is told apart at DNS cost,
+        an IP they do not answer stays out of it, it may be a real host next to the pool
+        Every IP is probed for once, concurrent callers share the probes
+        :param ips: IPs of the answer, in the wildcard subnets
+        :return: True if every IP is a wildcard IP
+        """
+        for ip in ips:
+            if ip in self.wildcard_index:
+                continue
+            task = self.subnet_confirmations.get(ip)
+            if task is None:
+                task = self.subnet_confirmations[ip] = asyncio.ensure_future(self.refine_wildcard())
+            await asyncio.shield(task)
+        return self.wildcard_index.issuperset(ips)
+
+    async def refine_wildcard(self):
+        labels = [f'feei-esd-{random.getrandbits(32):08x}' for _ in range(self.wildcard_probes)]
+        answers = await asyncio.gather(*(self.lookup(self.resolver, f'{label}.{self.domain}') for label in labels))
+        learned = {ip for ret in answers for ip in ret or ()} - self.wildcard_index
+        if learned:
+            self.wildcard_ips = sorted(self.wildcard_index | learned)
+            self.index_wildcard_ips()
+            logger.info(f'Wildcard pool refined: {sorted(learned)}, {len(self.wildcard_ips)} IPs')
+
+    def fetch_wildcard_html(self):
+        """
+        Fetch the responses of nonexistent subdomains as the RSC baseline
+        :return:
+        """
+        try:
+            self.wildcard_html, self.wildcard_fingerprint = self.fetch_wildcard_page(self.wildcard_sub)
+            self.wildcard_html_len = len(self.wildcard_html)
+            self.wildcard_html3, self.wildcard_fingerprint3 = self.fetch_wildcard_page(self.wildcard_sub3)
+            self.wildcard_html3_len = len(self.wildcard_html3)
             logger.info(
-                f'Will continue to test the distinct({len(subs)}-{len(self.data)})={len(self.wildcard_subs)} domains used by RSC, the speed will be affected.')
-            self.coroutine_count = self.coroutine_count_request
-            self.remainder = len(self.wildcard_subs)
-            tasks = (self.similarity(sub) for sub in self.wildcard_subs)
-            self.loop.run_until_complete(self.start_e(tasks, len(self.wildcard_subs)))
+                f'Wildcard domain response html length: {self.wildcard_html_len} 3length: {self.wildcard_html3_len}')
+        except requests.exceptions.SSLError:
+            logger.warning('SSL Certificate Error!')
+        except requests.exceptions.ConnectTimeout:
+            logger.warning('Request response content failed, check network please!')
+        except requests.exceptions.ReadTimeout:
+            self.wildcard_html = self.wildcard_html3 = ''
+            self.wildcard_html_len = self.wildcard_html3_len = 0
+            logger.warning(
+                f'Request response content timeout, {self.wildcard_sub}.{self.domain} and {self.wildcard_sub3}.{self.domain} maybe not a http service, content will be set to blank!')
+        except requests.exceptions.ConnectionError:
+            logger.error('ESD can\'t get the response text so the rsc will be skipped. ')
+            self.skip_rsc = True
+
+    def fetch_wildcard_page(self, sub):
+        """
+        Read a wildcard response within the same byte cap as the candidates
+        :param sub:
+        :return: cleaned html, (Content-Length, body head)
+        """
+        with requests.get(f'http://{sub}.{self.domain}', headers=self.request_headers, timeout=10, verify=False,
+                          stream=True) as response:
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(self.http_chunk_size):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= self.http_max_body:
+                    break
+            body = b''.join(chunks)[:self.http_max_body]
+            length = response.headers.get('Content-Length')
+            html = self.decode_body(body, response.headers.get('Content-Type'))
+        length = int(length) if length and length.isdigit() else None
+        return self.response_analyzer.clean(html), (length, body[:self.http_prefix_size])
 
-            # Distinct last domains use RSC
-            # Maybe misinformation
-            # self.distinct()
+    def wildcard_state(self):
+        """
+        Detection results handed to the worker processes
+        :return:
+        """
+        return {
+            'dns_servers': [s.address for s in self.resolver.servers],
+            'canary_domain': self.resolver.canary_domain,
+            'is_wildcard_domain': self.is_wildcard_domain,
+            'wildcard_sub': self.wildcard_sub,
+            'wildcard_sub3': self.wildcard_sub3,
+            'wildcard_ips': self.wildcard_ips,
+            'wildcard_html': self.wildcard_html,
+            'wildcard_html_len': self.wildcard_html_len,
+            'wildcard_html3': self.wildcard_html3,
+            'wildcard_html3_len': self.wildcard_html3_len,
+            'wildcard_fingerprint': self.wildcard_fingerprint,
+            'wildcard_fingerprint3': self.wildcard_fingerprint3,
+            'skip_rsc': self.skip_rsc,
+        }
 
-            time_consume_request = int(time.time() - dns_time)
-            logger.info(f'Requests time consume {str(datetime.timedelta(seconds=time_consume_request))}')
-        # RS(redirect/response) domains
-        while len(self.domains_rs) != 0:
-            logger.info(f'RS(redirect/response) domains({len(self.domains_rs)})...')
-            tasks = (self.similarity(''.join(domain.rsplit(self.domain, 1)).rstrip('.')) for domain in self.domains_rs)
+    def apply_wildcard_state(self, state, pool=None):
+        """
+        Use the detection results of the parent process or of a checkpoint instead of probing again
+        :param state:
+        :param pool: shared resolver pool, built here if not given
+        :return:
+        """
+        state = dict(state)
+        self.dns_servers = state.pop('dns_servers')
+        canary_domain = state.pop('canary_domain')
+        if pool is None:
+            pool = ResolverPool(self.dns_servers, self.new_resolver, self.loop,
+                                max_window=self.coroutine_count_dns, timeout=self.resolve_timeout)
+            pool.canary_domain = canary_domain
+        elif pool.canary_domain is None:
+            pool.canary_domain = canary_domain
+        self.resolver = pool
+        self.cache = DNSCache(self.resolver, self.loop)
+        for k, v in state.items():
+            setattr(self, k, v)
+        self.index_wildcard_ips()
 
-            self.loop.run_until_complete(self.start_e(tasks, len(self.domains_rs)))
+    @staticmethod
+    async def tracked(coro, watermark, index):
+        await coro
+        if index is not None:
+            watermark.finish(index)
 
-        # write output
+    async def brute(self):
+        """
+        Enumerate the dict by DNS, from the checkpointed position
+        :return:
+        """
+        self.phase = 'brute'
+        total = None
+        if not self.incremental or self.store is None:
+            # incremental mode skips the resting names, so their count is not known in advance
+            total = self.dict_size()
+            if total is not None:
+                total -= self.dict_progress.position
+        tasks = (self.tracked(self.query(sub), self.dict_progress, index)
+                 for index, sub in self.iter_brute_subs(self.dict_progress.position))
+        await self.start_e(tasks, total, self.coroutine_count_dns)
+        logger.info(f'Sub domain dict count: {self.dict_count}')
+        logger.info(f"Brute Force subdomain count: {self.count}")
+        if self.subnet_suspects:
+            logger.warning(f'--skip-rsc: {self.subnet_suspects} subdomains are in the wildcard subnets but not '
+                           f'wildcard IPs, they are kept with phase wildcard-subnet')
+        self.resolver.report()
+
+    async def compare(self, subs, subs_count, from_dict=False):
+        """
+        Enumerate subdomains of a wildcard domain by response similarity comparison
+        :param subs:
+        :param subs_count:
+        :param from_dict: subs are the dict loaded from the checkpointed position, else a list continued by index
+        :return:
+        """
+        self.phase = 'rsc'
+        if from_dict:
+            tasks = (self.tracked(self.similarity(sub), self.dict_progress, self.dict_count) for sub in subs)
+        else:
+            start = self.rsc_progress.position
+            if subs_count:
+                subs_count = max(subs_count - start, 0)
+            tasks = (self.tracked(self.similarity(sub), self.rsc_progress, i)
+                     for i, sub in itertools.islice(enumerate(subs, 1), start, None))
+        self.remainder = subs_count or 0
+        await self.start_e(tasks, subs_count, self.coroutine_count_request)
+
+    def start_workers(self, only_similarity):
+        """
+        Fan the dict out to worker processes, their results are merged
+        while the parent goes on with the other phases
+        :param only_similarity:
+        :return:
+        """
+        ctx = multiprocessing.get_context('spawn')
+        choose, count = self.shard
+        state = self.wildcard_state()
+        coroutine_count_dns = max(self.coroutine_count_dns // self.workers, 1)
+        self.workers_done = self.loop.create_future()
+        for w in range(self.workers):
+            parent_conn, child_conn = ctx.Pipe(duplex=False)
+            # nested shard: hash % (count * workers) % count == choose, so every worker
+            # takes 1/workers of the split shard
+            shard = (choose + count * w, count * self.workers)
+            process = ctx.Process(target=enum_worker, daemon=True,
+                                  args=(self.options, dict(state, shard_progress=self.shard_progress.get(shard),
+                                                           shard_candidates=self.shard_candidates.get(shard, [])),
+                                        shard, w == 0, only_similarity, coroutine_count_dns, child_conn))
+            process.start()
+            child_conn.close()
+            self.worker_conns[parent_conn] = process
+            self.loop.add_reader(parent_conn.fileno(), self.on_worker_message, parent_conn)
+        logger.info(f'Started {self.workers} worker processes')
+
+    def on_worker_message(self, conn):
+        """
+        Merge a message of a worker process
+        :param conn:
+        :return:
+        """
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            message = ('done', None)
+        if message[0] == 'data':
+            _, sub_domain, ips, phase = message
+            self.add_result(sub_domain, ips, phase)
+            if phase == 'brute':
+                self.count += 1
+                domain_domain_ips.append((sub_domain, ips))
+        elif message[0] == 'rsc':
+            self.wildcard_domains[message[1]] = message[2]
+        elif message[0] == 'rs':
+            self.discover(*message[1:])
+        elif message[0] == 'progress':
+            _, shard, dict_position, rsc_position, wildcard_subs = message
+            if self.sink is not None:
+                self.sink.candidates(wildcard_subs, shard)
+            self.shard_progress[shard] = {'dict_position': dict_position, 'rsc_position': rsc_position}
+        elif message[0] == 'done':
+            stats = message[1]
+            if stats is None:
+                logger.warning(f'Worker {self.worker_conns[conn].pid} exited unexpectedly')
+            else:
+                self.dict_count += stats['dict_count']
+                self.dns_query_errors += stats['dns_query_errors']
+                self.response_cache_hits += stats['response_cache_hits']
+                self.response_cache_misses += stats['response_cache_misses']
+            self.loop.remove_reader(conn.fileno())
+            self.worker_conns.pop(conn).join()
+            conn.close()
+            if not self.worker_conns:
+                self.workers_done.set_result(None)
+
+    async def join_workers(self):
+        await self.workers_done
+        logger.info(f'Sub domain dict count: {self.dict_count}')
+        logger.info(f"Brute Force subdomain count: {self.count}")
+
+    def report_changes(self, since):
+        """
+        Report the subdomains added and removed since the last run
+        :param since: start time of this run
+        :return:
+        """
+        added, removed = self.store.diff(set(self.data), since)
+        logger.info(f'Compared with the last run: {len(added)} added, {len(removed)} removed')
+        for sub_domain in added:
+            logger.info(f'+ {sub_domain}')
+        for sub_domain in removed:
+            logger.info(f'- {sub_domain}')
+
+    def write_output(self):
+        """
+        Write the results to tmp/.{domain}.esd, from the result sink if there is one
+        :return: results, subdomain -> IPs
+        """
+        results = self.data if self.sink is None else ResultSink.read(self.sink.path)
         tmp_dir = self.project_directory + '/tmp'
         if not os.path.isdir(tmp_dir):
             os.mkdir(tmp_dir, 0o777)
         output_path_with_time = f'{tmp_dir}/.{self.domain}_{datetime.datetime.now().strftime("%Y-%m_%d_%H-%M")}.esd'
         output_path = f'{tmp_dir}/.{self.domain}.esd'
-        if len(self.data):
-            max_domain_len = max(map(len, self.data)) + 2
+        if len(results):
+            max_domain_len = max(map(len, results)) + 2
         else:
             max_domain_len = 2
         output_format = '%-{0}s%-s\n'.format(max_domain_len)
         with open(output_path_with_time, 'w') as opt, open(output_path, 'w') as op:
-            for domain, ips in self.data.items():
+            for domain, ips in results.items():
                 # The format is consistent with other scanners to ensure that they are
                 # invoked at the same time without increasing the cost of
                 # resolution
@@ -812,11 +3015,246 @@ class EnumSubDomain(threading.Thread):
 
         logger.info(f'Output: {output_path}')
         logger.info(f'Output with time: {output_path_with_time}')
-        logger.info(f'Total domain: {len(self.data)}')
+        logger.info(f'Total domain: {len(results)}')
+        return results
+
+    def run(self):
+        """
+        Run
+        :return:
+        """
+        global task_flag
+        results = self.loop.run_until_complete(self.scan())
+        task_flag = True
+        return results
+
+    async def scan(self, servers=None, pool=None):
+        """
+        Enumerate the subdomains of the domain
+        :param servers: available DNS servers, checked here if not given
+        :param pool: shared resolver pool, built here if not given
+        :return:
+        """
+        logger.info(f'Version: {__version__}')
+        logger.info('----------')
+        logger.info(f'Start domain: {self.domain}')
+        start_time = time.time()
+        self.store = self.open_store()
+        checkpoint = self.load_checkpoint() if self.resume else None
+        resumed = ResultSink.read(self.sink_path) if checkpoint is not None else {}
+        self.sink = self.open_sink(append=checkpoint is not None)
+        self.data = resumed if self.sink is None else dict.fromkeys(resumed)
+        logger.info('Generate coroutines...')
+        self.start_frontier()
+        if checkpoint is None:
+            only_similarity = await self.detect_wildcard(servers, pool)
+        else:
+            only_similarity = self.restore_checkpoint(checkpoint, pool)
+        self.only_similarity = only_similarity
+        if self.sink is not None:
+            persist = asyncio.ensure_future(self.persist())
+        # CA subdomain info, from every live host found from now on
+        logger.info('Collect subdomains in CA...')
+        self.ca = CAInfo(self.domain)
+        for host in (f'www.{self.domain}', self.domain):
+            self.harvest(host)
+        # certificates are not checkpointed, harvest the hosts found before the interruption again
+        for sub_domain, ips in resumed.items():
+            if ips:
+                self.harvest(sub_domain, ips[0])
+        del resumed
+        # DNS Transfer Vulnerability, the names go to the frontier while the dict is enumerated
+        logger.info(f'Check DNS Transfer Vulnerability in {self.domain}')
+        transfer = asyncio.ensure_future(DNSTransfer(self.domain, self.cache.query, self.loop).transfer_info(
+            lambda name: self.discover(name, self.domain, 'axfr', verbose=False)))
+
+        if self.workers > 1:
+            self.start_workers(only_similarity)
+        elif not only_similarity:
+            await self.brute()
+        dns_time = time.time()
+        time_consume_dns = int(dns_time - start_time)
+        logger.info(f'DNS query errors: {self.dns_query_errors}')
+
+        transfer_info = await transfer
+        logger.info(f'DNS Transfer subdomain count: {len(transfer_info)}')
+
+        # Use TXT,SOA,MX,AAAA record to find sub domains
+        if self.multiresolve:
+            logger.info('Enumerating subdomains with TXT, SOA, MX, AAAA record...')
+            self.phase = 'dnsquery'
+            dnsquery = DNSQuery(self.domain, self.iter_total_subs(transfer_info), self.domain,
+                                self.cache.query, self.scheduler(self.coroutine_count_dns))
+            record_info = await dnsquery.dns_query()
+            tasks = (self.query(record) for record in record_info)
+            await self.start_e(tasks, len(record_info))
+            logger.info(f'DNS record subdomain count: {len(record_info)}')
+
+        if self.is_wildcard_domain and not self.skip_rsc:
+            # Response similarity comparison
+            if not only_similarity:
+                # names answered by other IPs are results already, only the wildcard answers are compared
+                wildcard_subs = list(dict.fromkeys(self.wildcard_subs))
+                subs_count = len(wildcard_subs)
+            elif self.workers > 1:
+                # the workers compare their dict shards, the names of the zone transfer are in the frontier
+                wildcard_subs = []
+                subs_count = 0
+            else:
+                subs_count = self.dict_count or None
+                wildcard_subs = self.load_sub_domain_dict(self.dict_progress.position)
+            logger.info(
+                f'Enumerates {len(self.data)} sub domains by DNS mode in {str(datetime.timedelta(seconds=time_consume_dns))}')
+            logger.info(
+                f'Will continue to test the distinct({self.dict_count}-{len(self.data)})={subs_count} domains used by RSC, the speed will be affected.')
+            await self.compare(wildcard_subs, subs_count, from_dict=only_similarity and self.workers <= 1)
+
+            time_consume_request = int(time.time() - dns_time)
+            logger.info(f'Requests time consume {str(datetime.timedelta(seconds=time_consume_request))}')
+        if self.workers > 1:
+            await self.join_workers()
+        # RS(redirect/response) domains
+        await self.drain_frontier()
+        if self.rsc_distinct and self.wildcard_domains:
+            # Distinct last domains use RSC
+            # Maybe misinformation, so only on --distinct
+            self.distinct()
+
+        await self.close_http_session()
+        self.close_analysis_executor()
+        if self.response_cache_hits or self.response_cache_misses:
+            logger.info(f'Response cache: hits={self.response_cache_hits} misses={self.response_cache_misses}')
+        self.cache.report()
+        if self.store is not None:
+            self.report_changes(start_time)
+            self.store.close()
+            self.store = None
+        if self.sink is not None:
+            persist.cancel()
+            self.sink.close()
+        # the scan is complete, a --resume starts a new one
+        if os.path.isfile(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        results = self.write_output()
         time_consume = int(time.time() - start_time)
         logger.info(f'Time consume: {str(datetime.timedelta(seconds=time_consume))}')
+        return results
+
+
+def enum_worker(options, state, shard, query_root, only_similarity, coroutine_count_dns, conn):
+    """
+    Worker process: enumerate one dict shard and stream the results to the parent
+    :param options: EnumSubDomain arguments
+    :param state: wildcard detection results of the parent
+    :param shard: (index, count) of the dict
+    :param query_root: whether this worker queries the root domain
+    :param only_similarity:
+    :param coroutine_count_dns: share of the DNS concurrency
+    :param conn: pipe to the parent
+    :return:
+    """
+    esd = EnumSubDomain(**options)
+    esd.shard = shard
+    esd.query_root = query_root
+    esd.result_conn = conn
+    esd.progress = False
+    esd.coroutine_count_dns = coroutine_count_dns
+    state = dict(state)
+    progress = state.pop('shard_progress')
+    wildcard_subs = state.pop('shard_candidates')
+    esd.apply_wildcard_state(state)
+    if progress is not None:
+        esd.restore_progress(progress, wildcard_subs)
+    esd.store = esd.open_store()
+    reporter = esd.loop.create_task(esd.report_progress())
+    try:
+        if not only_similarity:
+            esd.loop.run_until_complete(esd.brute())
+        if esd.is_wildcard_domain and not esd.skip_rsc:
+            if only_similarity:
+                esd.loop.run_until_complete(esd.compare(esd.load_sub_domain_dict(esd.dict_progress.position),
+                                                        esd.dict_count or None, from_dict=True))
+            else:
+                wildcard_subs = list(dict.fromkeys(esd.wildcard_subs))
+                esd.loop.run_until_complete(esd.compare(wildcard_subs, len(wildcard_subs)))
+            esd.loop.run_until_complete(esd.close_http_session())
+            esd.close_analysis_executor()
+    except Exception:
+        logger.error(traceback.format_exc())
+    reporter.cancel()
+    esd.send_progress()
+    if esd.store is not None:
+        # flushed before the parent compares with the last run
+        esd.store.close()
+    conn.send(('done', {'dict_count': esd.dict_count, 'dns_query_errors': esd.dns_query_errors,
+                        'response_cache_hits': esd.response_cache_hits,
+                        'response_cache_misses': esd.response_cache_misses}))
+    conn.close()
+
+
+class BatchEnumSubDomain(threading.Thread):
+    """
+    Enumerate many domains concurrently on one event loop
+    The DNS servers are checked once, the resolver pool, the compiled dict and
+    the in-flight budget are shared, so while one domain waits on CA, AXFR or
+    wildcard checks the others keep the resolvers busy.
+    """
+
+    def __init__(self, domains, **kwargs):
+        threading.Thread.__init__(self)
+        # every domain already runs on the same loop, no worker processes
+        kwargs['workers'] = 1
+        self.esds = [EnumSubDomain(d, **kwargs) for d in domains]
+        self.loop = asyncio.get_event_loop()
+
+    def run(self):
+        """
+        Run
+        :return:
+        """
+        global task_flag
+        self.loop.run_until_complete(self.scan())
         task_flag = True
-        return self.data
+
+    async def scan(self):
+        """
+        Enumerate all domains
+        :return:
+        """
+        if not self.esds:
+            return
+        first = self.esds[0]
+        servers = first.check_dns_servers()
+        logger.info(f'Use DNS servers: {servers or first.stable_dns_servers}')
+        pool = ResolverPool(servers or first.stable_dns_servers, first.new_resolver, self.loop,
+                            max_window=first.coroutine_count_dns, timeout=first.resolve_timeout)
+        compiled = first.open_compiled_dict()
+        schedulers = {}
+        # one analysis pool for all domains, its processes only start on the first submit
+        analysis_pool = first.analysis_executor() if first.analysis_workers else None
+        first.analysis_pool_owner = False
+        for esd in self.esds:
+            # interleaved progress bars are unreadable
+            esd.progress = False
+            esd.schedulers = schedulers
+            esd.compiled_dict = compiled
+            esd.analysis_pool = analysis_pool
+        start_time = time.time()
+        try:
+            results = await asyncio.gather(*(esd.scan(servers, pool) for esd in self.esds), return_exceptions=True)
+        finally:
+            if compiled is not None:
+                compiled.close()
+            if analysis_pool is not None:
+                analysis_pool.shutdown()
+        for esd, ret in zip(self.esds, results):
+            if isinstance(ret, Exception):
+                logger.error(f'{esd.domain} failed: {ret!r}')
+            else:
+                logger.info(f'{esd.domain}: {len(ret)} subdomains')
+        time_consume = int(time.time() - start_time)
+        logger.info(f'Total domains: {len(self.esds)} time consume: {str(datetime.timedelta(seconds=time_consume))}')
+
 
 class Heart(threading.Thread):
     
@@ -825,18 +3263,15 @@ class Heart(threading.Thread):
         
     
     def run(self):
-        logger.info(f"心跳已启动")
-        tmp_list = []
+        logger.info("心跳已启动")
         while True:
             send_list = []
-            for d_d_i in domain_domain_ips:
-                if d_d_i not in tmp_list:
-                    tmp_list.append(d_d_i)
-                    send_list.append(d_d_i)
+            while domain_domain_ips:
+                send_list.append(domain_domain_ips.popleft())
             logger.info(f"心跳 {send_list}")
             #跑完了 结束心跳
             if task_flag:
-                logger.info(f"心跳结束")
+                logger.info("心跳结束")
                 sys.exit(0)
             time.sleep(2)
 
@@ -865,6 +3300,35 @@ def main():
     parser.add_option('-p', '--proxy', dest='proxy', help='Use socks5 proxy to access Google and Yahoo')
     parser.add_option('-m', '--multi-resolve', dest='multiresolve',
                       help='Use TXT, AAAA, MX, SOA record to find subdomains', action='store_true', default=False)
+    parser.add_option('-w', '--wordlist', dest='wordlist', help='Custom wordlists used together with subs.esd')
+    parser.add_option('-c', '--compile-dict', dest='compile_dict',
+                      help='Compile the subdomain dicts into the binary dict cache and exit', action='store_true',
+                      default=False)
+    parser.add_option('--dns-servers', dest='dns_servers', help='DNS servers to spread the queries over, ie: 1.1.1.1,8.8.8.8')
+    parser.add_option('-e', '--engine', dest='engine', type='choice', choices=['aiodns', 'udp'], default='aiodns',
+                      help='DNS engine: aiodns or the built-in udp engine (aiodns by default)')
+    parser.add_option('--workers', dest='workers', type='int', default=1,
+                      help='Worker processes to fan the dict out to (1 by default)')
+    parser.add_option('-i', '--incremental', dest='incremental', action='store_true', default=False,
+                      help='Only re-check live subdomains and the NXDOMAIN ones due for a reprobe')
+    parser.add_option('--reprobe-days', dest='reprobe_days', type='float', default=7,
+                      help='Days before a NXDOMAIN subdomain is reprobed, doubled on every miss (7 by default)')
+    parser.add_option('--wildcard-probes', dest='wildcard_probes', type='int', default=16,
+                      help='Random labels resolved to learn the wildcard IP pool (16 by default)')
+    parser.add_option('--max-body', dest='max_body', type='int', default=1048576,
+                      help='Bytes of a response read for the similarity comparison (1048576 by default)')
+    parser.add_option('--similarity', dest='similarity', type='choice', choices=sorted(similarity_engines),
+                      default='length', help='Response similarity engine: length or simhash (length by default)')
+    parser.add_option('--distinct', dest='distinct', action='store_true', default=False,
+                      help='Drop RSC results which are near duplicates of each other')
+    parser.add_option('--analysis-workers', dest='analysis_workers', type='int', default=None,
+                      help='Processes analysing the RSC responses, 0 analyses them inline (CPU count up to 4 by default)')
+    parser.add_option('--http-per-host', dest='http_per_host', type='int', default=None,
+                      help='Connections per IP in the RSC phase (the requests in flight, 100, by default)')
+    parser.add_option('--resume', dest='resume', action='store_true', default=False,
+                      help='Continue the interrupted scan of the domain from its checkpoint, tmp/.{domain}.checkpoint')
+    parser.add_option('--batch', dest='batch', help='Enumerate all domains concurrently on one event loop',
+                      action='store_true', default=False)
     (options, args) = parser.parse_args()
 
     domains = []
@@ -873,6 +3337,12 @@ def main():
     split_list = options.split.split('/')
     split = options.split
     multiresolve = options.multiresolve
+    wordlists = options.wordlist.split(',') if options.wordlist else []
+    dns_servers = [d.strip() for d in options.dns_servers.split(',')] if options.dns_servers else None
+    for wordlist in wordlists:
+        if not os.path.isfile(wordlist):
+            logger.error(f'Wordlist not found: {wordlist}')
+            exit(0)
 
     try:
         if len(split_list) != 2 or int(split_list[0]) > int(split_list[1]):
@@ -890,6 +3360,15 @@ def main():
     else:
         proxy = {}
 
+    if 'esd' in os.environ:
+        debug = os.environ['esd']
+    else:
+        debug = False
+
+    if options.compile_dict:
+        EnumSubDomain('', debug=debug, wordlists=wordlists).compile_sub_domain_dict()
+        exit(0)
+
     if options.domains is not None:
         for p in options.domains.split(','):
             p = p.strip().lower()
@@ -910,28 +3389,45 @@ def main():
     else:
         logger.error('Please input vaild parameter. ie: "esd -d feei.cn" or "esd -f /Users/root/domains.txt"')
 
-    if 'esd' in os.environ:
-        debug = os.environ['esd']
-    else:
-        debug = False
     logger.info(f'Debug: {debug}')
     logger.info(f'--skip-rsc: {skip_rsc}')
 
     logger.info(f'Total target domains: {len(domains)}')
     try:
-        for d in domains:
-            #esd = EnumSubDomain(d, response_filter, skip_rsc=skip_rsc, debug=debug, split=split,
-            #                    proxy=proxy,
-            #                    multiresolve=multiresolve)
-            #esd.run()
-            thread_esd = EnumSubDomain(d, response_filter, skip_rsc=skip_rsc, debug=debug, split=split,
-                                proxy=proxy,
-                                multiresolve=multiresolve)
+        if options.batch:
+            thread_esd = BatchEnumSubDomain(domains, response_filter=response_filter, skip_rsc=skip_rsc, debug=debug,
+                                            split=split, proxy=proxy, multiresolve=multiresolve, wordlists=wordlists,
+                                            engine=options.engine, dns_servers=dns_servers,
+                                            incremental=options.incremental, reprobe_days=options.reprobe_days,
+                                            wildcard_probes=options.wildcard_probes, max_body=options.max_body,
+                                            similarity=options.similarity, rsc_distinct=options.distinct,
+                                            analysis_workers=options.analysis_workers, resume=options.resume,
+                                            http_per_host=options.http_per_host)
             thread_heart = Heart()
             thread_esd.start()
             thread_heart.start()
             thread_esd.join()
             thread_heart.join()
+        else:
+            for d in domains:
+                #esd = EnumSubDomain(d, response_filter, skip_rsc=skip_rsc, debug=debug, split=split,
+                #                    proxy=proxy,
+                #                    multiresolve=multiresolve)
+                #esd.run()
+                thread_esd = EnumSubDomain(d, response_filter, skip_rsc=skip_rsc, debug=debug, split=split,
+                                    proxy=proxy,
+                                    multiresolve=multiresolve, wordlists=wordlists, engine=options.engine,
+                                    dns_servers=dns_servers, workers=max(options.workers, 1),
+                                    incremental=options.incremental, reprobe_days=options.reprobe_days,
+                                    wildcard_probes=options.wildcard_probes, max_body=options.max_body,
+                                    similarity=options.similarity, rsc_distinct=options.distinct,
+                                    analysis_workers=options.analysis_workers, resume=options.resume,
+                                    http_per_host=options.http_per_host)
+                thread_heart = Heart()
+                thread_esd.start()
+                thread_heart.start()
+                thread_esd.join()
+                thread_heart.join()
     except KeyboardInterrupt:
         print('', end='\n')
         logger.info('Bye :)')
@@ -0,0 +1,82 @@
+import os
+import socket
+import struct
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class FakeDNS(threading.Thread):
+    """
+    Authoritative stand-in for the esd.test zone on port 53
+    Names in records answer their A or MX record, other types of them answer empty,
+    the names under a zone of wildcards answer its A record, every other name is NXDOMAIN.
+    """
+    records = {
+        ('www.baidu.com', 1): '127.0.0.78',
+        ('esd.test', 1): '127.0.0.78',
+        ('www.esd.test', 1): '127.0.0.78',
+        ('mail.esd.test', 1): '127.0.0.78',
+        ('mx.esd.test', 1): '127.0.0.78',
+        ('esd.test', 15): 'mx.esd.test',
+    }
+    # *.zone.esd.test
+    wildcards = {'zone.esd.test': '127.0.1.79'}
+
+    def __init__(self, address):
+        threading.Thread.__init__(self, daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, 53))
+
+    @staticmethod
+    def question(data):
+        labels = []
+        offset = 12
+        while data[offset]:
+            length = data[offset]
+            labels.append(data[offset + 1:offset + 1 + length].decode())
+            offset += 1 + length
+        qtype, = struct.unpack('!H', data[offset + 1:offset + 3])
+        return '.'.join(labels).lower(), qtype, data[12:offset + 5]
+
+    @staticmethod
+    def encode(name):
+        return b''.join(bytes([len(label)]) + label.encode() for label in name.split('.')) + b'\x00'
+
+    def answer(self, data):
+        name, qtype, question = self.question(data)
+        zone = name.partition('.')[2]
+        if zone in self.wildcards:
+            value = self.wildcards[zone] if qtype == 1 else None
+        elif not any(known == name for known, _ in self.records):
+            return data[:2] + b'\x81\x83\x00\x01\x00\x00\x00\x00\x00\x00' + question
+        else:
+            value = self.records.get((name, qtype))
+        if value is None:
+            return data[:2] + b'\x81\x80\x00\x01\x00\x00\x00\x00\x00\x00' + question
+        if qtype == 1:
+            rdata = socket.inet_aton(value)
+        else:
+            rdata = struct.pack('!H', 10) + self.encode(value)
+        rr = b'\xc0\x0c' + struct.pack('!HHIH', qtype, 1, 60, len(rdata)) + rdata
+        return data[:2] + b'\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00' + question + rr
+
+    def run(self):
+        while True:
+            data, address = self.sock.recvfrom(4096)
+            self.sock.sendto(self.answer(data), address)
+
+
+@pytest.fixture(scope='session')
+def fake_dns():
+    address = '127.0.0.77'
+    try:
+        server = FakeDNS(address)
+    except OSError as e:
+        pytest.skip(f'can not listen on {address}:53, {e}')
+    server.start()
+    return address
@@ -0,0 +1,106 @@
+import asyncio
+
+import aiodns
+import pytest
+
+import subdomain_brute as sb
+
+
+class Resolver(object):
+    """
+    Answers www with one A record, the other names with the given error
+    """
+
+    def __init__(self, error=4, ttl=60):
+        self.error = error
+        self.ttl = ttl
+        self.queries = 0
+        self.gate = None
+
+    async def query(self, host, qtype):
+        self.queries += 1
+        if self.gate is not None:
+            await self.gate.wait()
+        if host.lower().startswith('www.'):
+            return [sb.ARecord('127.0.0.78', self.ttl)]
+        raise aiodns.error.DNSError(self.error, 'error')
+
+
+@pytest.fixture
+def clock():
+    loop = asyncio.new_event_loop()
+    now = [1000.0]
+    loop.time = lambda: now[0]
+    yield loop, now
+    loop.close()
+
+
+def test_concurrent_lookups_share_one_query(clock):
+    loop, _ = clock
+    resolver = Resolver()
+    cache = sb.DNSCache(resolver, loop)
+
+    async def lookups():
+        resolver.gate = asyncio.Event()
+        waiting = [asyncio.ensure_future(cache.query('WWW.esd.test', 'A')) for _ in range(10)]
+        await asyncio.sleep(0)
+        resolver.gate.set()
+        return await asyncio.gather(*waiting)
+
+    answers = loop.run_until_complete(lookups())
+    assert resolver.queries == 1
+    assert (cache.misses, cache.coalesced) == (1, 9)
+    assert answers == [[sb.ARecord('127.0.0.78', 60)]] * 10
+    assert cache.inflight == {}
+
+
+@pytest.mark.parametrize('error, cached', [(4, True), (1, True), (12, False), (3, False)])
+def test_only_negative_answers_are_cached(clock, error, cached):
+    loop, now = clock
+    resolver = Resolver(error)
+    cache = sb.DNSCache(resolver, loop, negative_ttl=300)
+    for _ in range(2):
+        with pytest.raises(aiodns.error.DNSError):
+            loop.run_until_complete(cache.query('nope.esd.test', 'A'))
+    # timeouts and server failures are asked again, NXDOMAIN and no data are not
+    assert resolver.queries == (1 if cached else 2)
+    now[0] += 301
+    with pytest.raises(aiodns.error.DNSError):
+        loop.run_until_complete(cache.query('nope.esd.test', 'A'))
+    assert resolver.queries == (2 if cached else 3)
+
+
+def test_answers_expire_with_their_ttl(clock):
+    loop, now = clock
+    resolver = Resolver(ttl=60)
+    cache = sb.DNSCache(resolver, loop)
+    loop.run_until_complete(cache.query('www.esd.test', 'A'))
+    now[0] += 59
+    loop.run_until_complete(cache.query('www.esd.test', 'A'))
+    assert (resolver.queries, cache.hits) == (1, 1)
+    now[0] += 2
+    loop.run_until_complete(cache.query('www.esd.test', 'A'))
+    assert resolver.queries == 2
+
+
+def test_ttl_is_capped_and_zero_is_not_cached(clock):
+    loop, now = clock
+    cache = sb.DNSCache(Resolver(ttl=86400), loop, max_ttl=3600)
+    loop.run_until_complete(cache.query('www.esd.test', 'A'))
+    assert cache.entries[('www.esd.test', 'A')][0] == now[0] + 3600
+    cache = sb.DNSCache(Resolver(ttl=0), loop)
+    loop.run_until_complete(cache.query('www.esd.test', 'A'))
+    assert cache.entries == {}
+
+
+def test_expired_entries_are_purged(clock):
+    loop, now = clock
+    cache = sb.DNSCache(Resolver(), loop)
+    cache.purge_at = 3
+    for i in range(3):
+        cache.put((f'n{i}.esd.test', 'A'), None, None, 10)
+    now[0] += 11
+    cache.put(('www.esd.test', 'A'), None, None, 10)
+    assert list(cache.entries) == [('www.esd.test', 'A')]
+    # the next purge waits for twice the live entries, at least the default
+    assert cache.purge_at == 10000
@@ -0,0 +1,42 @@
+import asyncio
+import collections
+
+import dns.resolver
+
+import subdomain_brute as sb
+
+MX = collections.namedtuple('MX', 'exchange')
+
+# a.esd.test and mx.a.esd.test answer themselves, the walk must end anyway
+MX_RECORDS = {
+    'esd.test': ['a.esd.test', 'other.test'],
+    'a.esd.test': ['esd.test', 'a.esd.test', 'mx.a.esd.test'],
+    'mx.a.esd.test': ['mx.a.esd.test', 'a.esd.test'],
+}
+
+
+def test_records_are_walked_breadth_first_once():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    queries = collections.Counter()
+    inflight = [0, 0]
+
+    async def query(name, rdtype):
+        queries[name, rdtype] += 1
+        inflight[0] += 1
+        inflight[1] = max(inflight)
+        await asyncio.sleep(0)
+        inflight[0] -= 1
+        if rdtype != 'MX' or name not in MX_RECORDS:
+            raise dns.resolver.NoAnswer()
+        return [MX(f'{exchange}.') for exchange in MX_RECORDS[name]]
+
+    dnsquery = sb.DNSQuery('esd.test', ['www'], 'esd.test', query, sb.FairScheduler(3))
+    found = loop.run_until_complete(dnsquery.dns_query())
+    loop.close()
+    asyncio.set_event_loop(None)
+    assert found == ['a.esd.test', 'mx.a.esd.test']
+    names = {'esd.test', 'www.esd.test', 'a.esd.test', 'mx.a.esd.test'}
+    assert queries == collections.Counter({(name, rdtype): 1 for name in names for rdtype in sb.DNSQuery.record_types})
+    # every record type of a name takes its own slot of the shared budget
+    assert inflight[1] == 3
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+import subdomain_brute as sb
+
+
+class Content(object):
+    def __init__(self, body):
+        self.body = body
+        self.read = 0
+
+    async def iter_chunked(self, size):
+        for i in range(0, len(self.body), size):
+            self.read += 1
+            yield self.body[i:i + size]
+
+
+class Response(object):
+    def __init__(self, body, content_type='text/html', content_length=None):
+        self.content = Content(body)
+        self.content_length = len(body) if content_length is None else content_length
+        self.headers = {'Content-Type': content_type}
+
+
+@pytest.fixture
+def esd():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    esd = sb.EnumSubDomain('esd.test', max_body=10000)
+    esd.http_chunk_size = 1024
+    esd.http_prefix_size = 1024
+    yield esd
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def read(esd, response, baseline=None):
+    return esd.loop.run_until_complete(esd.read_body(response, baseline))
+
+
+def test_body_is_capped(esd):
+    response = Response(b'x' * 100000)
+    assert read(esd, response) == 'x' * 10000
+    assert response.content.read == 10
+
+
+def test_wildcard_page_is_cut_off_after_its_head(esd):
+    body = b'<html>parked' + b'x' * 5000
+    baseline = (len(body), body[:1024]), 'cleaned wildcard page'
+    response = Response(body)
+    assert read(esd, response, baseline) == 'cleaned wildcard page'
+    assert response.content.read == 1
+
+
+@pytest.mark.parametrize('content_length, head', [(None, b'<html>other!'), (6000, b'<html>parked')])
+def test_other_pages_are_read_whole(esd, content_length, head):
+    body = head + b'x' * 5000
+    baseline = (5012, (b'<html>parked' + b'x' * 5000)[:1024]), 'cleaned wildcard page'
+    assert read(esd, Response(body, content_length=content_length), baseline) == body.decode()
+
+
+@pytest.mark.parametrize('charset', ['gbk', 'utf-8'])
+def test_cap_inside_a_character_keeps_the_charset(esd, charset):
+    text = '子域名' * 5000
+    esd.http_max_body = 10001
+    html = read(esd, Response(text.encode(charset), f'text/html; charset={charset}'))
+    # only the cut character is replaced
+    assert html[:-1] == text[:len(html) - 1]
+    assert html[-1] == '�'
+
+
+def test_unknown_charset_falls_back_to_utf8(esd):
+    assert read(esd, Response('子域名'.encode('utf-8'), 'text/html; charset=x-unknown')) == '子域名'
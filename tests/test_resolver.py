@@ -0,0 +1,154 @@
+import asyncio
+import struct
+
+import aiodns
+import dns.exception
+import dns.resolver
+import pytest
+
+import subdomain_brute as sb
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+class Refusing(object):
+    def __init__(self, code):
+        self.code = code
+
+    async def query(self, host, qtype):
+        raise aiodns.error.DNSError(self.code, 'refused')
+
+
+@pytest.mark.parametrize('code', [6, 10, 11])
+def test_error_answers_shrink_the_window_and_quarantine(code):
+    loop = asyncio.new_event_loop()
+    pool = sb.ResolverPool(['192.0.2.1'], lambda servers: Refusing(code), loop)
+
+    async def scan():
+        for i in range(200):
+            with pytest.raises(aiodns.error.DNSError):
+                await pool.query(f'n{i}.esd.test', 'A')
+
+    loop.run_until_complete(scan())
+    loop.close()
+    server = pool.servers[0]
+    assert server.window < 100
+    assert server.nx == 0
+    assert server.quarantine_reason is not None
+
+
+QUESTION = b'\x03www\x03esd\x04test\x00\x00\x01\x00\x01'
+
+
+def response(rcode=0, answers=(), question=QUESTION, txid=7):
+    """
+    DNS response to QUESTION
+    :param answers: (owner name, type, rdata), the owner name is wire encoded or a pointer
+    """
+    rrs = b''.join(name + struct.pack('!HHIH', rtype, 1, 60, len(rdata)) + rdata for name, rtype, rdata in answers)
+    return struct.pack('!HHHHHH', txid, 0x8180 | rcode, 1, len(answers), 0, 0) + question + rrs
+
+
+@pytest.mark.parametrize('data, code', [
+    (response(rcode=3), 4),
+    (response(), 1),
+    # a CNAME only, its target was not answered
+    (response(answers=[(b'\xc0\x0c', 5, b'\x03cdn\xc0\x10')]), 1),
+    # cut in the middle of the answer
+    (response(answers=[(b'\xc0\x0c', 1, b'\x7f\x00\x00\x4e')])[:-6], 10),
+    (response(rcode=2), 3),
+    (response(rcode=5), 6),
+])
+def test_parse_errors(data, code, loop):
+    with pytest.raises(aiodns.error.DNSError) as e:
+        sb.UDPResolver('127.0.0.1', loop=loop).parse(data, len(QUESTION))
+    assert e.value.args[0] == code
+
+
+def test_parse_follows_a_cname_chain(loop):
+    data = response(answers=[
+        (b'\xc0\x0c', 5, b'\x03cdn\xc0\x10'),
+        # uncompressed owner name
+        (b'\x03cdn\x03esd\x04test\x00', 5, b'\x04edge\x03net\x00'),
+        (b'\x04edge\x03net\x00', 1, b'\x7f\x00\x00\x4e'),
+        (b'\x04edge\x03net\x00', 1, b'\x7f\x00\x00\x4f'),
+    ])
+    records = sb.UDPResolver('127.0.0.1', loop=loop).parse(data, len(QUESTION))
+    assert records == [sb.ARecord('127.0.0.78', 60), sb.ARecord('127.0.0.79', 60)]
+
+
+def test_skip_name():
+    data = b'\x03cdn\x03esd\x04test\x00' + b'\x03www\xc0\x04'
+    assert sb.UDPResolver.skip_name(data, 0) == 14
+    assert sb.UDPResolver.skip_name(data, 14) == len(data)
+
+
+class Capture(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        pass
+
+
+def test_answers_need_the_question_and_a_random_id():
+    loop = asyncio.new_event_loop()
+    resolver = sb.UDPResolver('127.0.0.1', loop=loop)
+    resolver.transport = Capture()
+
+    async def scan():
+        queries = [asyncio.ensure_future(resolver.query('www.esd.test', 'A')) for _ in range(64)]
+        await asyncio.sleep(0)
+        txids = [struct.unpack_from('!H', data)[0] for data in resolver.transport.sent]
+        assert len(set(txids)) == 64
+        assert sum(b - a == 1 for a, b in zip(txids, txids[1:])) < 8
+        answer = [(b'\xc0\x0c', 1, b'\x7f\x00\x00\x4e')]
+        for txid in txids:
+            # an answer to another question is stale or spoofed
+            resolver.datagram_received(response(answers=answer, question=b'\x03ww2' + QUESTION[4:], txid=txid), None)
+        assert len(resolver.pending) == 64
+        for txid in txids:
+            resolver.datagram_received(response(answers=answer, txid=txid), None)
+        return await asyncio.gather(*queries)
+
+    results = loop.run_until_complete(scan())
+    resolver.close()
+    loop.close()
+    assert results == [[sb.ARecord('127.0.0.78', 60)]] * 64
+
+
+@pytest.mark.parametrize('host', ['a' * 64 + '.esd.test', 'www..esd.test', 'www.' + 'a' * 64 + '.test',
+                                  '.'.join(['abcdefg'] * 40)])
+def test_names_the_wire_format_can_not_hold_are_not_sent(host):
+    loop = asyncio.new_event_loop()
+    resolver = sb.UDPResolver('127.0.0.1', loop=loop)
+    resolver.transport = Capture()
+    with pytest.raises(aiodns.error.DNSError) as e:
+        loop.run_until_complete(resolver.query(host, 'A'))
+    loop.close()
+    assert e.value.args[0] == 8
+    assert resolver.transport.sent == []
+
+
+@pytest.mark.parametrize('error, stat', [(dns.resolver.NXDOMAIN, 'nx'), (dns.exception.Timeout, 'timeouts'),
+                                         (dns.resolver.NoNameservers, 'servfails')])
+def test_other_record_types_are_counted_by_the_pool(loop, error, stat):
+    pool = sb.ResolverPool(['192.0.2.1'], lambda servers: Refusing(6), loop)
+
+    class Resolver(object):
+        async def resolve(self, host, rdtype):
+            raise error()
+
+    server = pool.servers[0]
+    server.records_resolver = Resolver()
+    with pytest.raises(error):
+        loop.run_until_complete(pool.resolve('esd.test', 'MX'))
+    assert (server.sent, getattr(server, stat), server.inflight) == (1, 1, 0)
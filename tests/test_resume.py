@@ -0,0 +1,116 @@
+import asyncio
+import json
+import pickle
+
+import pytest
+
+import subdomain_brute as sb
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def scanner(tmp_path, **kwargs):
+    esd = sb.EnumSubDomain('esd.test', dns_servers=['127.0.0.1'], **kwargs)
+    esd.sink_path = str(tmp_path / '.esd.test.jsonl')
+    esd.checkpoint_path = str(tmp_path / '.esd.test.checkpoint')
+    return esd
+
+
+def test_watermark_waits_for_the_gaps():
+    watermark = sb.Watermark()
+    for index in (2, 3, 5, 1, 4, 7):
+        watermark.finish(index)
+    assert watermark.position == 5
+    assert watermark.finished == {7}
+
+
+def test_resting_names_advance_the_dict_position(tmp_path, loop):
+    esd = scanner(tmp_path, incremental=True)
+    esd.store = sb.ResolutionStore(str(tmp_path / '.esd.db'), 'esd.test')
+    for sub in 'bce':
+        esd.store.observe(f'{sub}.esd.test', None, None)
+    esd.store.observe('live.esd.test', ['127.0.0.78'], 60)
+    esd.store.flush()
+
+    def load_sub_domain_dict(start=0):
+        for esd.dict_count, sub in enumerate('abcdef', 1):
+            if esd.dict_count > start:
+                yield sub
+
+    esd.load_sub_domain_dict = load_sub_domain_dict
+    brute = list(esd.iter_brute_subs())
+    assert brute == [(1, 'a'), (4, 'd'), (6, 'f'), (None, 'live')]
+    for index, sub in brute:
+        if index is not None:
+            esd.dict_progress.finish(index)
+    assert esd.dict_progress.position == 6
+    esd.store.close()
+
+
+def test_candidates_are_kept_in_the_sink(tmp_path, loop):
+    esd = scanner(tmp_path)
+    esd.resolver = sb.ResolverPool(['127.0.0.1'], esd.new_resolver, loop)
+    esd.sink = sb.ResultSink(esd.sink_path)
+    esd.sink.write('www.esd.test', ['127.0.0.78'], 'brute')
+    esd.sink.write('cert.esd.test', ['127.0.0.78'], 'certificate')
+    esd.rs_seen = {'cert.esd.test': 'certificate', 'gone.esd.test': 'response', 'next.esd.test': 'redirect'}
+    esd.rs_pending = {'next.esd.test'}
+    esd.wildcard_subs = ['a.esd.test', 'b.esd.test']
+    esd.dict_progress.finish(1)
+    esd.save_checkpoint()
+    esd.wildcard_subs.append('c.esd.test')
+    esd.save_checkpoint()
+    esd.sink.close()
+
+    with open(esd.checkpoint_path) as fp:
+        checkpoint = json.load(fp)
+    assert checkpoint['progress'] == {'0/1': {'dict_position': 1, 'rsc_position': 0}}
+    # only the unchecked names, the checked ones are rebuilt from the sink
+    assert checkpoint['rs_pending'] == {'next.esd.test': 'redirect'}
+    assert 'rs_seen' not in checkpoint
+    assert sb.ResultSink.read(esd.sink_path) == {'www.esd.test': ['127.0.0.78'], 'cert.esd.test': ['127.0.0.78']}
+
+    resumed = scanner(tmp_path, resume=True)
+    resumed.rs_queue = asyncio.Queue()
+    resumed.restore_checkpoint(resumed.load_checkpoint())
+    assert resumed.wildcard_subs == ['a.esd.test', 'b.esd.test', 'c.esd.test']
+    assert resumed.dict_progress.position == 1
+    assert resumed.rs_seen == {'cert.esd.test': 'certificate', 'next.esd.test': 'redirect'}
+    assert resumed.rs_queue.get_nowait() == 'next.esd.test'
+
+
+def test_pickled_checkpoints_are_not_loaded(tmp_path, loop):
+    esd = scanner(tmp_path, resume=True)
+    open(esd.sink_path, 'w').close()
+    with open(esd.checkpoint_path, 'wb') as fp:
+        pickle.dump({'version': sb.__version__, 'domain': 'esd.test', 'shard': (0, 1)}, fp)
+    assert esd.load_checkpoint() is None
+
+
+def test_dict_size_counts_the_shard(tmp_path):
+    path = str(tmp_path / '.subs.esdc')
+    labels = [f'n{i}' for i in range(1000)]
+    sb.CompiledDict.compile(path, b'\0' * 32, labels)
+    compiled = sb.CompiledDict(path)
+    for count in (1, 3):
+        assert sum(compiled.shard_size(index, count) for index in range(count)) == 1000
+        for index in range(count):
+            assert compiled.shard_size(index, count) == len(list(compiled.iter_shard(index, count)))
+    compiled.close()
+
+
+def test_results_in_the_sink_keep_only_their_names(tmp_path, loop):
+    esd = scanner(tmp_path)
+    esd.sink = sb.ResultSink(esd.sink_path)
+    esd.harvest = lambda host, ip=None: None
+    esd.add_result('www.esd.test', ['127.0.0.78'], 'brute')
+    esd.sink.close()
+    assert esd.data == {'www.esd.test': None}
+    assert sb.ResultSink.read(esd.sink_path) == {'www.esd.test': ['127.0.0.78']}
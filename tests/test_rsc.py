@@ -0,0 +1,39 @@
+import asyncio
+import urllib.parse
+
+import pytest
+
+import subdomain_brute as sb
+
+PARKED = '<html><body>  parked domain, for sale  <script>var x = 1;</script></body></html>'
+
+
+@pytest.mark.parametrize('analysis_workers', [0, 1])
+def test_parked_hosts_share_one_analysis(analysis_workers):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    esd = sb.EnumSubDomain('esd.test', analysis_workers=analysis_workers)
+    esd.progress = False
+    esd.is_wildcard_domain = True
+    esd.wildcard_ips = ['127.0.0.78']
+    esd.wildcard_html = esd.wildcard_html3 = esd.response_analyzer.clean(PARKED)
+    esd.wildcard_html_len = esd.wildcard_html3_len = len(esd.wildcard_html)
+
+    async def fetch(session, url, baseline=None):
+        host = urllib.parse.urlsplit(url).hostname
+        if host.startswith('park'):
+            return PARKED, []
+        return f'<html><body>the site of {host}, {"with a longer page " * 10}</body></html>', []
+
+    esd.fetch = fetch
+    subs = [f'park{i}' for i in range(300)] + ['web0', 'web1', 'web2', 'web2']
+    try:
+        loop.run_until_complete(esd.compare(subs, len(subs)))
+        loop.run_until_complete(esd.close_http_session())
+    finally:
+        esd.close_analysis_executor()
+        loop.close()
+        asyncio.set_event_loop(None)
+    assert set(esd.data) == {'web0.esd.test', 'web1.esd.test', 'web2.esd.test'}
+    # the parked page is analysed once, so is the page of web2
+    assert (esd.response_cache_hits, esd.response_cache_misses) == (300, 4)
@@ -0,0 +1,32 @@
+import os
+import shutil
+import subprocess
+import sys
+
+from conftest import ROOT
+
+
+def run_esd(tmp_path, dns_server, *args):
+    """
+    Scan in a copy of the project, with a three-name dict
+    :return: results of tmp/.{domain}.esd, output of the scan
+    """
+    for name in ('subdomain_brute.py', 'cacert.pem'):
+        shutil.copy(os.path.join(ROOT, name), tmp_path)
+    (tmp_path / 'subs.esd').write_text('www\nmail\nnope\n')
+    proc = subprocess.run([sys.executable, 'subdomain_brute.py', '-d', 'esd.test',
+                           '--dns-servers', dns_server] + list(args),
+                          cwd=tmp_path, capture_output=True, text=True, timeout=60)
+    output = proc.stdout + proc.stderr
+    assert proc.returncode == 0, output
+    assert 'Traceback' not in output, output
+    with open(tmp_path / 'tmp' / '.esd.test.esd') as fp:
+        return {line.split()[0] for line in fp if line.strip()}, output
+
+
+def test_multiresolve_with_workers(tmp_path, fake_dns):
+    # the parent of the workers runs the -m phase without running brute() itself,
+    # the records are resolved by the --dns-servers, not the system resolver
+    results, output = run_esd(tmp_path, fake_dns, '-m', '--workers', '2')
+    assert results == {'esd.test', 'www.esd.test', 'mail.esd.test', 'mx.esd.test'}
+    assert 'DNS record subdomain count: 1' in output
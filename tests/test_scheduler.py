@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+import subdomain_brute as sb
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+async def record(order, name):
+    order.append(name)
+    await asyncio.sleep(0)
+
+
+def test_every_coroutine_runs(loop):
+    order = []
+
+    class Progress(object):
+        n = 0
+
+        def update(self, n):
+            self.n += n
+
+    progress = Progress()
+    loop.run_until_complete(sb.FairScheduler(4).run((record(order, i) for i in range(10)), progress))
+    assert sorted(order) == list(range(10))
+    assert progress.n == 10
+
+
+def test_callers_take_turns(loop):
+    order = []
+    scheduler = sb.FairScheduler(1)
+    loop.run_until_complete(asyncio.gather(scheduler.run(record(order, ('a', i)) for i in range(3)),
+                                           scheduler.run(record(order, ('b', i)) for i in range(3))))
+    assert order == [('a', 0), ('b', 0), ('a', 1), ('b', 1), ('a', 2), ('b', 2)]
+
+
+def test_failing_task_source_is_raised(loop):
+    order = []
+
+    def coros():
+        yield record(order, 0)
+        raise FileNotFoundError('subs-test.esd')
+
+    scheduler = sb.FairScheduler(2)
+    with pytest.raises(FileNotFoundError):
+        loop.run_until_complete(asyncio.wait_for(scheduler.run(coros()), 5))
+    # the other callers of the scheduler go on
+    loop.run_until_complete(asyncio.wait_for(scheduler.run(record(order, i) for i in range(1, 3)), 5))
+    assert sorted(order) == [0, 1, 2]
+
+
+def test_failing_coroutine_is_raised(loop):
+    async def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        loop.run_until_complete(asyncio.wait_for(sb.FairScheduler(2).run(iter([fail()])), 5))
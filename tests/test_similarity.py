@@ -0,0 +1,51 @@
+import asyncio
+import random
+import string
+from difflib import SequenceMatcher
+
+import pytest
+
+import subdomain_brute as sb
+
+
+def test_length_similarity_is_real_quick_ratio():
+    rnd = random.Random(7)
+    pages = [''.join(rnd.choice(string.printable) for _ in range(rnd.randrange(0, 300))) for _ in range(200)]
+    engine = sb.LengthSimilarity()
+    for a, b in zip(pages, reversed(pages)):
+        expected = SequenceMatcher(None, a, b).real_quick_ratio()
+        assert engine.ratio(engine.fingerprint(a), engine.fingerprint(b)) == expected
+
+
+def test_analyzer_ratio_matches_sequence_matcher():
+    analyzer = sb.ResponseAnalyzer('esd.test', sb.LengthSimilarity(), None)
+    baseline = analyzer.clean('<html><body>parked <script>track()</script> page</body></html>')
+    for html in ('<html>parked page</html>', '<html><body>a real site of www.esd.test</body></html>', ''):
+        ratio, _, _, _ = analyzer(html, len(baseline), len(baseline))
+        cleaned = analyzer.clean(html)
+        if len(cleaned) == len(baseline):
+            assert ratio == 1
+        else:
+            assert ratio == round(SequenceMatcher(None, cleaned, baseline).real_quick_ratio(), 3)
+
+
+@pytest.mark.parametrize('wildcard_html', [None, ''])
+def test_candidates_are_kept_out_without_a_baseline(wildcard_html):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    esd = sb.EnumSubDomain('esd.test', analysis_workers=0)
+    esd.is_wildcard_domain = True
+    esd.wildcard_ips = ['127.0.0.78']
+    esd.wildcard_html = esd.wildcard_html3 = wildcard_html
+    esd.wildcard_html_len = esd.wildcard_html3_len = 0
+
+    async def fetch(session, url, baseline=None):
+        return '<html>a page of its own</html>', []
+
+    esd.fetch = fetch
+    loop.run_until_complete(esd.similarity('www'))
+    loop.run_until_complete(esd.close_http_session())
+    loop.close()
+    asyncio.set_event_loop(None)
+    # a failed baseline fetch compares nothing, an empty wildcard page is a baseline
+    assert list(esd.data) == ([] if wildcard_html is None else ['www.esd.test'])
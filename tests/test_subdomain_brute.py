@@ -0,0 +1,103 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import subdomain_brute as sb
+
+
+@pytest.fixture
+def esd(fake_dns):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    esd = sb.EnumSubDomain('esd.test', dns_servers=[fake_dns])
+    esd.resolver = sb.ResolverPool([fake_dns], esd.new_resolver, loop)
+    esd.cache = sb.DNSCache(esd.resolver, loop)
+    esd.index_wildcard_ips()
+    yield esd
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def test_zone_wildcard_answers_are_dropped(esd):
+    wildcard_subs = []
+    esd.loop.run_until_complete(esd.query('home.zone', wildcard_subs))
+    esd.loop.run_until_complete(esd.query('www', wildcard_subs))
+    # no RSC baseline for *.zone.esd.test, so neither a result nor an RSC candidate
+    assert wildcard_subs == []
+    assert set(esd.data) == {'www.esd.test'}
+
+
+def test_frontier_compares_apex_wildcard_answers_only(esd):
+    compared = []
+
+    async def similarity(sub):
+        compared.append(sub)
+
+    esd.similarity = similarity
+    esd.is_wildcard_domain = True
+    esd.wildcard_ips = ['127.0.0.78']
+    esd.index_wildcard_ips()
+    for name in ('x.zone.esd.test', 'www.esd.test', 'nope.esd.test'):
+        esd.loop.run_until_complete(esd.check_discovered(name))
+    # x.zone.esd.test is answered by *.zone.esd.test, the apex page is no baseline for it
+    assert compared == ['www']
+    assert esd.data == {}
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='counts the open file descriptors in /proc')
+def test_probe_closes_its_resolver(esd, fake_dns):
+    esd.engine = 'udp'
+    esd.loop.run_until_complete(esd.probe(fake_dns))
+    fds = len(os.listdir('/proc/self/fd'))
+    for _ in range(20):
+        esd.loop.run_until_complete(esd.probe(fake_dns))
+    assert len(os.listdir('/proc/self/fd')) == fds
+
+
+@pytest.mark.parametrize('skip_rsc', [False, True])
+def test_wildcard_subnet_neighbours_stay_out_of_the_index(esd, skip_rsc, tmp_path):
+    # www.esd.test answers 127.0.0.78, next to the probed wildcard IP, random labels never answer it
+    esd.is_wildcard_domain = True
+    esd.skip_rsc = skip_rsc
+    esd.wildcard_ips = ['127.0.0.1']
+    esd.index_wildcard_ips()
+    esd.sink = sb.ResultSink(str(tmp_path / '.esd.test.jsonl'))
+    wildcard_subs = []
+    esd.loop.run_until_complete(esd.query('www', wildcard_subs))
+    esd.sink.close()
+    assert esd.wildcard_index == {'127.0.0.1'}
+    # RSC tells a neighbour from the wildcard, without RSC it is kept as a suspect
+    if skip_rsc:
+        assert wildcard_subs == []
+        assert esd.subnet_suspects == 1
+        with open(esd.sink.path) as fp:
+            assert [json.loads(line)['phase'] for line in fp] == ['wildcard-subnet']
+    else:
+        assert wildcard_subs == ['www.esd.test']
+        assert esd.data == {}
+
+
+@pytest.mark.parametrize('skip_rsc', [False, True])
+def test_wildcard_pool_is_refined_by_probes(fake_dns, skip_rsc):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # *.zone.esd.test answers 127.0.1.79, the first probes only saw 127.0.1.1
+    esd = sb.EnumSubDomain('zone.esd.test', dns_servers=[fake_dns], skip_rsc=skip_rsc)
+    esd.resolver = sb.ResolverPool([fake_dns], esd.new_resolver, loop)
+    esd.cache = sb.DNSCache(esd.resolver, loop)
+    esd.is_wildcard_domain = True
+    esd.wildcard_ips = ['127.0.1.1']
+    esd.index_wildcard_ips()
+    wildcard_subs = []
+    for sub in ('a', 'b'):
+        loop.run_until_complete(esd.query(sub, wildcard_subs))
+    loop.close()
+    asyncio.set_event_loop(None)
+    assert esd.wildcard_index == {'127.0.1.1', '127.0.1.79'}
+    # the IP is confirmed once, b is classified by the index
+    assert list(esd.subnet_confirmations) == ['127.0.1.79']
+    assert esd.data == {}
+    assert esd.subnet_suspects == 0
+    assert wildcard_subs == ([] if skip_rsc else ['a.zone.esd.test', 'b.zone.esd.test'])